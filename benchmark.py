@@ -0,0 +1,216 @@
+## Benchmark of the run_v2.py polling cycle
+## Starts local fake OpenDTU and Domoticz servers (see fake_servers.py), runs
+## the cycle of run_v2.py against them for every scenario, and reports the
+## cycles per second, the p50 / p99 cycle latency and the request counts.
+## The websocket engine processes the frames pushed by the fake /livedata
+## websocket, optionally dropping the connections to exercise the reconnects,
+## or pausing the pushes to exercise the silent socket fallback.
+## Results can be saved as JSON and compared with a run of another version:
+##   python benchmark.py --inverters 4 16 64 --engines sync async --output new.json --compare old.json
+##   python benchmark.py --engines websocket --push-interval 0.01 --drop-interval 2
+##   python benchmark.py --engines websocket --stale-interval 1 --stale-after 0.2
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fake_servers
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def percentile(values: list, percent: float):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def build_config(scenario: dict, dtu_url: str, domoticz_url: str, serials: list):
+    """data.json used by run_v2.py for one scenario."""
+    return {
+        'solar_units': {serial: {'idx': str(100 + index), 'name': f'Inverter {index + 1}', 'max_power': 400} for index, serial in enumerate(serials)},
+        'telegram': {'token': 'benchmark', 'chat_id': '0'},
+        'global_solar': {'idx': '1', 'name': 'Solar'},
+        'global_solar_historic': {'idx': '2', 'name': 'P1 Meter'},
+        'global_config': {
+            'dtu_base_url': dtu_url,
+            'domoticz_base_url': domoticz_url,
+            # Not used, the worker runs the cycles back to back
+            'sleep_duration': 1,
+            'single_request': scenario['single_request'],
+            'async_engine': scenario['engine'] == 'async',
+            'websocket': scenario['engine'] == 'websocket',
+            'max_concurrency': scenario['max_concurrency'],
+            'write_deadband': scenario['write_deadband'],
+            'websocket_stale_after': scenario['stale_after']
+        }
+    }
+
+def run_worker(cycles: int, engine: str):
+    """Run in a scenario directory: import run_v2 and time its cycles. Prints the durations as JSON."""
+    sys.path.insert(0, REPO_DIR)
+    import run_v2
+    run_v2.logger.setLevel(logging.WARNING)
+    durations = []
+    if engine == 'async':
+        async def run_cycles():
+            semaphore = asyncio.Semaphore(run_v2.max_concurrency)
+            for _ in range(cycles):
+                tic = time.perf_counter()
+                await run_v2.run_cycle_async(semaphore)
+                durations.append(time.perf_counter() - tic)
+        asyncio.run(run_cycles())
+    elif engine == 'websocket':
+        # Loop of main_websocket without its sleep : a push cycle per batch of pushed changes,
+        # HTTP polling while the websocket is down or silent. Only the processing is timed, not the wait for a push.
+        feed = run_v2.dtu_websocket.LiveDataFeed(run_v2.dtu_base_url, reconnect_delay=0.1)
+        feed.start()
+        deadline = time.monotonic() + 5
+        while not feed.connected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for _ in range(cycles):
+            if feed.connected and not feed.is_stale(run_v2.websocket_stale_after):
+                changed, total_changed = feed.wait_for_changes(min(1, run_v2.websocket_stale_after))
+                tic = time.perf_counter()
+                run_v2.run_push_cycle(feed, changed, total_changed)
+            else:
+                tic = time.perf_counter()
+                run_v2.run_cycle()
+            durations.append(time.perf_counter() - tic)
+        feed.stop()
+    else:
+        for _ in range(cycles):
+            tic = time.perf_counter()
+            run_v2.run_cycle()
+            durations.append(time.perf_counter() - tic)
+    print(json.dumps(durations))
+
+def run_scenario(scenario: dict, args):
+    dtu = fake_servers.FakeOpenDTU(
+        inverters     = scenario['inverters'],
+        full_status   = not args.summary_status,
+        latency       = args.dtu_latency,
+        jitter        = args.jitter,
+        error_rate    = args.error_rate,
+        seed          = args.seed,
+        push_interval = args.push_interval
+    ).start()
+    domoticz = fake_servers.FakeDomoticz(latency=args.domoticz_latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed).start()
+    stop_dropping = threading.Event()
+    if scenario['engine'] == 'websocket' and args.drop_interval > 0:
+        def drop_websockets():
+            while not stop_dropping.wait(args.drop_interval):
+                dtu.drop_websockets()
+        threading.Thread(target=drop_websockets, daemon=True).start()
+    if scenario['engine'] == 'websocket' and args.stale_interval > 0:
+        def toggle_stale():
+            # The connections stay open, but the pushes stop for every other interval
+            while not stop_dropping.wait(args.stale_interval):
+                dtu.websocket_stale = not dtu.websocket_stale
+        threading.Thread(target=toggle_stale, daemon=True).start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'data.json'), 'w') as file:
+                json.dump(build_config(scenario, dtu.base_url, domoticz.base_url, dtu.serials), file)
+            # Each scenario runs in a fresh interpreter, since run_v2.py loads its configuration at import
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--worker', '--cycles', str(args.cycles), '--engines', scenario['engine']],
+                cwd=directory, capture_output=True, text=True
+            )
+        if result.returncode != 0:
+            raise RuntimeError(f"Scenario {scenario} failed:\n{result.stderr}")
+        durations = json.loads(result.stdout.strip().splitlines()[-1])
+    finally:
+        stop_dropping.set()
+        dtu.stop()
+        domoticz.stop()
+    return {
+        **scenario,
+        'cycles': len(durations),
+        'cycles_per_second': len(durations) / sum(durations),
+        'p50_ms': percentile(durations, 50) * 1000,
+        'p99_ms': percentile(durations, 99) * 1000,
+        'mean_ms': statistics.mean(durations) * 1000,
+        'dtu_requests': dict(dtu.requests),
+        'domoticz_requests': dict(domoticz.requests),
+        'dtu_requests_per_cycle': sum(dtu.requests.values()) / len(durations),
+        'domoticz_requests_per_cycle': sum(domoticz.requests.values()) / len(durations),
+        'injected_errors': dtu.errors + domoticz.errors,
+        'websocket_pushes': dtu.pushed
+    }
+
+def scenario_key(result: dict):
+    return f"{result['engine']}/inv={result['inverters']}/single={result['single_request']}/conc={result['max_concurrency']}"
+
+def print_results(results: list, baseline: dict = None):
+    print(f"{'scenario':<40} {'cycles/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'DTU/cyc':>8} {'Domo/cyc':>9}")
+    for result in results:
+        key = scenario_key(result)
+        line = f"{key:<40} {result['cycles_per_second']:>9.2f} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['dtu_requests_per_cycle']:>8.2f} {result['domoticz_requests_per_cycle']:>9.2f}"
+        previous = (baseline or {}).get(key)
+        if previous:
+            line += f"   p50 x{result['p50_ms'] / previous['p50_ms']:.2f}  p99 x{result['p99_ms'] / previous['p99_ms']:.2f}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the run_v2.py cycle against local fake OpenDTU and Domoticz servers')
+    parser.add_argument('--inverters', type=int, nargs='+', default=[4, 16, 64], help='Inverter counts to benchmark')
+    parser.add_argument('--engines', nargs='+', choices=['sync', 'async', 'websocket'], default=['sync', 'async'])
+    parser.add_argument('--single-request', choices=['on', 'off', 'both'], default='both', help='single_request mode of the scenarios')
+    parser.add_argument('--max-concurrency', type=int, default=8)
+    parser.add_argument('--write-deadband', type=float, default=0)
+    parser.add_argument('--cycles', type=int, default=30)
+    parser.add_argument('--dtu-latency', type=float, default=0.02, help='Mean DTU answer delay, in seconds')
+    parser.add_argument('--domoticz-latency', type=float, default=0.005, help='Mean Domoticz answer delay, in seconds')
+    parser.add_argument('--jitter', type=float, default=0.005, help='Maximum random deviation of the delays, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of requests answered with HTTP 500')
+    parser.add_argument('--push-interval', type=float, default=0.01, help='Seconds between two frames pushed by the fake /livedata websocket')
+    parser.add_argument('--drop-interval', type=float, default=0, help='Websocket engine: drop the websocket connections every this many seconds (0 never)')
+    parser.add_argument('--stale-interval', type=float, default=0, help='Websocket engine: pause and resume the pushes every this many seconds (0 never)')
+    parser.add_argument('--stale-after', type=float, default=30, help='websocket_stale_after of the scenarios, in seconds')
+    parser.add_argument('--summary-status', action='store_true', help='Global status without per-inverter fields, forcing ?inv= requests')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.cycles, args.engines[0])
+        return
+
+    single_modes = {'on': [True], 'off': [False], 'both': [False, True]}[args.single_request]
+    scenarios = [
+        {'engine': engine, 'inverters': inverters, 'single_request': single_request, 'max_concurrency': args.max_concurrency, 'write_deadband': args.write_deadband,
+         'stale_after': args.stale_after}
+        for engine in args.engines for inverters in args.inverters for single_request in single_modes
+    ]
+    results = [run_scenario(scenario, args) for scenario in scenarios]
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = {scenario_key(result): result for result in json.load(file)['results']}
+    print_results(results, baseline)
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'worker')}
+        with open(args.output, 'w') as file:
+            json.dump({'version': git_version(), 'python': sys.version.split()[0], 'settings': settings, 'results': results}, file, indent=4)
+
+if __name__ == '__main__':
+    main()
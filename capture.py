@@ -0,0 +1,144 @@
+## Capture of the DTU traffic, for profiling and regression tests
+## CaptureWriter appends every /api/livedata/status response (global and
+## ?inv=) with its timestamp to a gzip compressed JSON lines file, with a
+## marker at the start of each polling cycle. read_cycles() reads a capture
+## back one cycle at a time, it is used by replay.py.
+## Each cycle is written as a complete gzip member, so a crash loses at most
+## the cycle in progress: the reader stops at a truncated member, and the
+## next run cuts it off before appending.
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Bytes read at a time from a capture
+CHUNK_SIZE = 1 << 16
+
+def split_url(url: str):
+    """Return (host, path with query) of a DTU URL, without the credentials."""
+    parts = urlsplit(url)
+    host = parts.hostname or ''
+    if parts.port:
+        host = f'{host}:{parts.port}'
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    return host, path
+
+class CaptureWriter:
+    """Append the DTU responses to a compressed JSON lines capture."""
+
+    def __init__(self, path: str, clock=time.time):
+        self.path   = path
+        self.clock  = clock
+        self.cycles = 0
+        self._lines = []
+        self._lock  = threading.Lock()
+        if os.path.exists(path):
+            _truncate_incomplete(path)
+        self._file  = open(path, 'ab')
+
+    def _write(self, entry: dict):
+        line = json.dumps(entry, separators=(',', ':'))
+        with self._lock:
+            self._lines.append(line + '\n')
+
+    def flush(self):
+        """Append the buffered entries to the file as one complete gzip member."""
+        with self._lock:
+            if not self._lines:
+                return
+            self._file.write(gzip.compress(''.join(self._lines).encode('utf-8'), compresslevel=6))
+            self._file.flush()
+            self._lines = []
+
+    def start_cycle(self):
+        """Mark the start of a polling cycle, and flush the previous one to disk."""
+        self.flush()
+        self.cycles += 1
+        self._write({'t': self.clock(), 'cycle': self.cycles})
+
+    def record(self, url: str, data):
+        """Record one response, data is None when the request failed."""
+        host, path = split_url(url)
+        self._write({'t': self.clock(), 'host': host, 'url': path, 'data': data})
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._file.close()
+
+def _decompress(path: str):
+    """Yield (data, end) over the gzip members of a capture, end is the offset after a member once it is complete.
+
+    Stops with a warning at a truncated or corrupt member, e.g. after a crash of the writer.
+    """
+    with open(path, 'rb') as file:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        offset, started, data = 0, False, b''
+        while True:
+            data = data or file.read(CHUNK_SIZE)
+            if not data:
+                break
+            try:
+                text = decompressor.decompress(data)
+            except zlib.error as e:
+                logger.warning(f'Capture {path} is corrupt after {offset} bytes, the rest is ignored: {e}')
+                return
+            started = True
+            if decompressor.eof:
+                # End of a member, the rest of the chunk starts the next one
+                offset += len(data) - len(decompressor.unused_data)
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                started = False
+                yield text, offset
+            else:
+                offset += len(data)
+                data = b''
+                yield text, None
+        if started:
+            logger.warning(f'Capture {path} ends with a truncated member (the writer stopped abruptly), the rest is ignored')
+
+def _truncate_incomplete(path: str):
+    """Cut off a truncated last member, so that the members appended next stay readable."""
+    complete = 0
+    for _, end in _decompress(path):
+        if end is not None:
+            complete = end
+    if complete < os.path.getsize(path):
+        logger.warning(f'Capture {path} : {os.path.getsize(path) - complete} bytes of an incomplete cycle removed')
+        os.truncate(path, complete)
+
+def read_entries(path: str):
+    pending = b''
+    for text, end in _decompress(path):
+        lines = (pending + text).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+        if end is not None:
+            # A member always ends with a complete line
+            pending = b''
+
+def read_cycles(path: str):
+    """Yield (timestamp, responses) per cycle, responses maps (host, url) to the list of data in order."""
+    timestamp, responses = None, None
+    for entry in read_entries(path):
+        if 'cycle' in entry:
+            if responses is not None:
+                yield timestamp, responses
+            timestamp, responses = entry['t'], {}
+            continue
+        if responses is None:
+            # Responses before the first marker (capture started mid-cycle)
+            timestamp, responses = entry['t'], {}
+        responses.setdefault((entry['host'], entry['url']), []).append(entry['data'])
+    if responses is not None:
+        yield timestamp, responses
@@ -0,0 +1,119 @@
+## Per-inverter circuit breaker for the ?inv= requests
+## A breaker opens after failure_threshold consecutive failed requests, or
+## right away when the DTU itself reports the inverter as not reachable.
+## While open, the inverter is only probed at growing intervals (doubling
+## from probe_delay up to max_probe_delay), and at most max_probes open
+## inverters are probed per cycle. It closes as soon as a request succeeds,
+## or, when it was opened because the DTU reported the inverter not
+## reachable, as soon as the DTU reports it reachable again.
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class CircuitBreaker:
+    """Health state of one inverter."""
+
+    def __init__(self, name: str, failure_threshold: int = 3, probe_delay: float = 30, max_probe_delay: float = 900, clock=time.monotonic):
+        self.name                 = name
+        self.failure_threshold    = failure_threshold
+        self.probe_delay          = probe_delay
+        self.max_probe_delay      = max_probe_delay
+        self.clock                = clock
+        self.open                 = False
+        self.unreachable          = False
+        self.consecutive_failures = 0
+        self.probes               = 0
+        self.next_probe           = 0
+
+    def _open(self, reason: str):
+        if not self.open:
+            logger.warning(f'Inverter {self.name} : circuit opened ({reason}), probing at growing intervals')
+            self.open = True
+            self.probes = 0
+        self.next_probe = self.clock() + min(self.max_probe_delay, self.probe_delay * 2 ** self.probes)
+
+    def _close(self):
+        if self.open:
+            logger.info(f'Inverter {self.name} : circuit closed')
+        self.open = False
+        self.unreachable = False
+        self.consecutive_failures = 0
+        self.probes = 0
+
+    def probe_due(self):
+        return not self.open or self.clock() >= self.next_probe
+
+    def record_success(self):
+        self._close()
+
+    def record_failure(self, unreachable: bool = False):
+        """A request without data, or (unreachable) an answer where the DTU reports the inverter not reachable."""
+        self.consecutive_failures += 1
+        if self.open:
+            # A failed probe : wait twice as long for the next one
+            self.probes += 1
+            self._open('probe failed')
+        elif unreachable:
+            self.unreachable = True
+            self._open('not reachable according to the DTU')
+        elif self.consecutive_failures >= self.failure_threshold:
+            self._open(f'{self.consecutive_failures} consecutive failures')
+
+    def observe(self, reachable: bool):
+        """Apply the reachable flag of the global status, the probe schedule of an open breaker is kept."""
+        if reachable:
+            # Requests which failed while the DTU sees the inverter are not fixed by this flag
+            if self.unreachable:
+                self._close()
+        elif not self.open:
+            self.unreachable = True
+            self._open('not reachable according to the DTU')
+
+class BreakerSet:
+    """Circuit breakers of all inverters, with a probe budget per cycle."""
+
+    def __init__(self, max_probes: int = 2, clock=time.monotonic, **breaker_settings):
+        self.max_probes        = max_probes
+        self.clock             = clock
+        self.breaker_settings  = breaker_settings
+        self.breakers          = {}
+        self._probes_left      = max_probes
+        self._lock             = threading.Lock()
+
+    def configure(self, max_probes: int, **breaker_settings):
+        """Change the settings, of the existing breakers too."""
+        with self._lock:
+            self.max_probes = max_probes
+            self.breaker_settings = breaker_settings
+            for breaker in self.breakers.values():
+                for key, value in breaker_settings.items():
+                    setattr(breaker, key, value)
+
+    def get(self, serial: str, name: str = None):
+        with self._lock:
+            breaker = self.breakers.get(serial)
+            if breaker is None:
+                breaker = self.breakers[serial] = CircuitBreaker(name or serial, clock=self.clock, **self.breaker_settings)
+            return breaker
+
+    def start_cycle(self):
+        with self._lock:
+            self._probes_left = self.max_probes
+
+    def allow(self, serial: str, name: str = None):
+        """Whether a request may be sent to this inverter in the current cycle."""
+        breaker = self.get(serial, name)
+        with self._lock:
+            if not breaker.open:
+                return True
+            if not breaker.probe_due() or self._probes_left <= 0:
+                return False
+            self._probes_left -= 1
+            return True
+
+    def open_count(self):
+        with self._lock:
+            return sum(1 for breaker in self.breakers.values() if breaker.open)
@@ -0,0 +1,212 @@
+## Typed configuration of run_v2.py, loaded from data.json
+## The file is parsed and validated into frozen records, with the defaults
+## of every global_config key declared once below. ConfigWatcher checks the
+## file between cycles and returns the new configuration when it changed,
+## so that run_v2.py applies it without a restart. An invalid file is
+## reported and the running configuration is kept.
+
+import dataclasses
+import json
+import logging
+import os
+import types
+from typing import Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+class ConfigError(ValueError):
+    """data.json is not a valid configuration."""
+
+@dataclasses.dataclass(frozen=True)
+class SolarUnit:
+    serial: str
+    idx: str
+    name: str
+    max_power: float = 400
+    gateway: Optional[str] = None
+
+@dataclasses.dataclass(frozen=True)
+class Device:
+    idx: str
+    name: str
+
+@dataclasses.dataclass(frozen=True)
+class GlobalConfig:
+    dtu_base_url: Optional[str] = None
+    gateways: Optional[tuple] = None
+    domoticz_base_url: Optional[str] = None
+    sleep_duration: float = 3
+    night_sleep_duration: float = 60
+    sunrise_ramp: float = 3600
+    single_request: bool = False
+    max_data_age: float = 10
+    async_engine: bool = False
+    max_concurrency: int = 4
+    websocket: bool = False
+    websocket_stale_after: float = 30
+    write_deadband: float = 0
+    write_heartbeat: float = 300
+    state_path: str = 'state.json'
+    state_flush_delay: float = 30
+    sample_db: Optional[str] = 'samples.db'
+    replay_batch: int = 100
+    metrics_port: Optional[int] = None
+    metrics_address: str = '0.0.0.0'
+    domoticz_output: str = 'http'
+    config_reload: bool = True
+    capture_path: Optional[str] = None
+    energy_max_gap: float = 900
+    energy_tolerance: float = 0.1
+    breaker_threshold: int = 3
+    breaker_probe_delay: float = 30
+    breaker_max_probe_delay: float = 900
+    breaker_max_probes: int = 2
+    log_level: str = 'INFO'
+    log_format: str = 'text'
+    log_rate_limit: float = 300
+    underperformance_alerts: bool = False
+    underperformance_threshold: float = 0.2
+    underperformance_window: float = 86400
+    snapshot_port: Optional[int] = None
+    snapshot_address: str = '127.0.0.1'
+
+@dataclasses.dataclass(frozen=True)
+class Config:
+    solar_units: Mapping[str, SolarUnit]
+    global_solar: Device
+    global_solar_historic: Device
+    global_config: GlobalConfig
+    # Sections handed as is to their module (notifier, http_sessions, mqtt_output)
+    telegram: Mapping
+    http: Mapping
+    mqtt: Mapping
+
+# Settings which are only read at startup
+RESTART_SETTINGS = ('dtu_base_url', 'gateways', 'async_engine', 'max_concurrency', 'websocket', 'state_path',
+                    'sample_db', 'metrics_port', 'metrics_address', 'domoticz_output', 'capture_path',
+                    'snapshot_port', 'snapshot_address')
+
+# Smallest value of the numbers which cannot be 0 (the others must not be negative)
+MINIMUMS = {'max_concurrency': 1, 'replay_batch': 1, 'breaker_threshold': 1, 'sleep_duration': 0.5, 'night_sleep_duration': 0.5}
+
+def _check_type(section: str, key: str, value, expected, minimum: float = 0):
+    """Check one value against a field annotation, ints are accepted for floats."""
+    optional = getattr(expected, '__origin__', None) is not None
+    if optional:
+        if value is None:
+            return value
+        expected = expected.__args__[0]
+    if expected is float and isinstance(value, int) and not isinstance(value, bool):
+        value = float(value)
+    if not isinstance(value, expected) or (expected in (int, float) and isinstance(value, bool)):
+        raise ConfigError(f'{section}.{key} must be {expected.__name__}, not {value!r}')
+    if expected in (int, float) and value < minimum:
+        raise ConfigError(f'{section}.{key} must be at least {minimum}' if minimum else f'{section}.{key} must not be negative')
+    return value
+
+def _section(data: dict, name: str):
+    section = data.get(name, {})
+    if not isinstance(section, dict):
+        raise ConfigError(f'{name} must be an object')
+    return section
+
+def _device(data: dict, name: str):
+    section = _section(data, name)
+    if section.get('idx') is None:
+        raise ConfigError(f'{name}.idx is missing')
+    return Device(str(section['idx']), section.get('name', name))
+
+def parse_global_config(section: dict):
+    values = {}
+    for field in dataclasses.fields(GlobalConfig):
+        # A missing key takes the default, an explicit null is kept (e.g. sample_db: null disables the store)
+        if field.name not in section or field.name == 'gateways':
+            continue
+        values[field.name] = _check_type('global_config', field.name, section[field.name], field.type, MINIMUMS.get(field.name, 0))
+    if section.get('gateways') is not None:
+        if not isinstance(section['gateways'], list) or not section['gateways']:
+            raise ConfigError('global_config.gateways must be a non empty list')
+        gateways = []
+        for entry in section['gateways']:
+            if not isinstance(entry, dict) or not entry.get('name') or not entry.get('dtu_base_url'):
+                raise ConfigError('Each entry of global_config.gateways needs a name and a dtu_base_url')
+            gateways.append(types.MappingProxyType(dict(entry)))
+        values['gateways'] = tuple(gateways)
+    elif not values.get('dtu_base_url'):
+        raise ConfigError('global_config.dtu_base_url or global_config.gateways is required')
+    if values.get('domoticz_output', 'http') not in ('http', 'mqtt'):
+        raise ConfigError(f"global_config.domoticz_output must be 'http' or 'mqtt', not {values['domoticz_output']!r}")
+    if values.get('log_format', 'text') not in ('text', 'json'):
+        raise ConfigError(f"global_config.log_format must be 'text' or 'json', not {values['log_format']!r}")
+    if 'log_level' in values:
+        values['log_level'] = values['log_level'].upper()
+    if not isinstance(logging.getLevelName(values.get('log_level', 'INFO')), int):
+        raise ConfigError(f"global_config.log_level {values['log_level']!r} is not a logging level")
+    return GlobalConfig(**values)
+
+def parse_solar_units(section: dict, gateway_names: set):
+    units = {}
+    for serial, unit in section.items():
+        if not isinstance(unit, dict) or unit.get('idx') is None or not unit.get('name'):
+            raise ConfigError(f'solar_units.{serial} needs an idx and a name')
+        gateway = unit.get('gateway')
+        if gateway is not None and gateway not in gateway_names:
+            raise ConfigError(f'solar_units.{serial}.gateway {gateway!r} is not a configured gateway')
+        max_power = _check_type(f'solar_units.{serial}', 'max_power', unit.get('max_power', 400), float)
+        units[str(serial)] = SolarUnit(str(serial), str(unit['idx']), unit['name'], max_power, gateway)
+    return types.MappingProxyType(units)
+
+def parse_config(data: dict):
+    """Build a Config from the content of data.json, raises ConfigError when it is invalid."""
+    if not isinstance(data, dict):
+        raise ConfigError('data.json must hold an object')
+    global_config = parse_global_config(_section(data, 'global_config'))
+    gateway_names = {entry['name'] for entry in global_config.gateways or ()} or {'default'}
+    return Config(
+        solar_units           = parse_solar_units(_section(data, 'solar_units'), gateway_names),
+        global_solar          = _device(data, 'global_solar'),
+        global_solar_historic = _device(data, 'global_solar_historic'),
+        global_config         = global_config,
+        telegram              = types.MappingProxyType(_section(data, 'telegram')),
+        http                  = types.MappingProxyType(_section(data, 'http')),
+        mqtt                  = types.MappingProxyType(_section(data, 'mqtt'))
+    )
+
+def load_config(path: str):
+    with open(path, 'r') as file:
+        try:
+            data = json.load(file)
+        except ValueError as e:
+            raise ConfigError(f'{path} is not valid JSON: {e}') from e
+    return parse_config(data)
+
+class ConfigWatcher:
+    """Reload the configuration file when it changes on disk."""
+
+    def __init__(self, path: str, current: Config):
+        self.path      = path
+        self.current   = current
+        self._stamp    = self._file_stamp()
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def poll(self):
+        """Return the new Config when the file changed and is valid, else None. Costs one stat call."""
+        stamp = self._file_stamp()
+        if stamp is None or stamp == self._stamp:
+            return None
+        self._stamp = stamp
+        try:
+            new = load_config(self.path)
+        except (OSError, ConfigError) as e:
+            logger.error(f'Configuration not reloaded, keeping the running one: {e}')
+            return None
+        if new == self.current:
+            return None
+        self.current = new
+        return new
@@ -1,4 +1,6 @@
 import requests
+import http_sessions
+import livedata
 import time
 import logging
 
@@ -28,6 +30,11 @@ serial_to_datas = {
     '1125xxxxxxxx': {'idx': '1129', 'name': 'Extension 2', 'max_power': 400}
 }
 
+# Pooled keep-alive sessions, with the timeouts and retry policy of each endpoint
+dtu_session      = http_sessions.create_session('dtu')
+domoticz_session = http_sessions.create_session('domoticz')
+telegram_session = http_sessions.create_session('telegram')
+
 # Initialize the production state for each inverter
 solar_production = {serial: False for serial in serial_to_datas.keys()}
 
@@ -50,7 +57,7 @@ def get_inverter_live_data(inverter):
 
 def fetch_data(url):
     try:
-        response = requests.get(url)
+        response = dtu_session.get(url)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -59,15 +66,14 @@ def fetch_data(url):
 
 def update_domoticz_solar(IDX, POWER, ENERGY):
     update_url = f"{domoticz_base_url}/json.htm?type=command&param=udevice&idx={IDX}&nvalue=0&svalue={str(POWER)};{str(ENERGY)}"
-    response = requests.get(update_url)
+    response = domoticz_session.get(update_url)
     if response.status_code == 200:
         return response
 
 def send_message_by_telegram(MESSAGE, TOKEN, CHATID):
-    import requests
     url = f"https://api.telegram.org/bot{TOKEN}/sendMessage?chat_id={CHATID}&text={MESSAGE}"
     try:
-        print(requests.get(url).json()) # this sends the message
+        print(telegram_session.get(url).json()) # this sends the message
         return True
     except Exception as e:
         logging.error(e)
@@ -77,11 +83,11 @@ while True:
     try:
         global_tic = time.perf_counter()
         tic = time.perf_counter()
-        live_data = get_live_data()
-        if live_data is not None:
+        live = livedata.parse_live_data(get_live_data())
+        if live is not None and live.total is not None:
             # Update Global Solar Datas
-            current_power = (round(float(live_data.get('total')['Power'].get('v')), 1))
-            yield_day = (float(live_data.get('total')['YieldDay'].get('v')))
+            current_power = round(float(live.total.power), 1)
+            yield_day = float(live.total.yield_day)
             response = update_domoticz_solar(idx_global, current_power, yield_day)
             toc = time.perf_counter()
             logging.debug(f"1 - Duration : {toc - tic:0.4f} seconds. HTTP : {response.status_code}")
@@ -93,21 +99,26 @@ while True:
                 idx  = data['idx']
                 name = data['name']
                 # For each serial number, query to openDTU
-                live_data = get_inverter_live_data(serial)
-                if live_data is not None:
-                    if live_data and 'inverters' in live_data:
-                        inverter_data = live_data['inverters'][0]
+                inverter_live_data = get_inverter_live_data(serial)
+                if inverter_live_data is not None:
+                    if inverter_live_data.get('inverters'):
+                        inverter = livedata.parse_inverter(inverter_live_data['inverters'][0])
                         # Check if the inverter is producing energy
-                        if inverter_data['producing']:
+                        if inverter.producing:
                             # Check if it was NOT producing during previous run :
                             if not solar_production[serial]:
                                 # If it was not, then this a production start from the morning
                                 solar_production[serial] = True
                                 send_message_by_telegram(f"Starting Solar Production for {name}", TG_TOKEN, TG_CHATID)
-                            power = round(float(inverter_data['INV']['0']['Power DC']['v']), 1)
-                            energy = int(inverter_data['INV']['0']['YieldDay']['v'])
-                            response = update_domoticz_solar(idx, power, energy)
-                            logging.debug(f"Inverter {serial} : HTTP {response.status_code}\n")
+                            power, energy = livedata.inverter_power(inverter)
+                            if power is None or energy is None:
+                                # Writing 0 instead would put a fake drop in the Domoticz history
+                                logging.warning(f'Inverter {name} ({serial}) : Power DC or YieldDay missing')
+                            else:
+                                power = round(float(power), 1)
+                                energy = int(energy)
+                                response = update_domoticz_solar(idx, power, energy)
+                                logging.debug(f"Inverter {serial} : HTTP {response.status_code}\n")
                         else:
                             # Check if it was producing during previous run :
                             if solar_production[serial]:
@@ -141,7 +152,7 @@ while True:
             # Send Daily Report
             if not daily_report_sent and notif_all_stopped:
                 logging.info('Time to send Daily Production Message')
-                yield_day = (float(live_data.get('total')['YieldDay'].get('v')))
+                yield_day = float(live.total.yield_day)
                 energy_in_kwh = yield_day / 1000
                 message = (f"🌞 Production Solaire du Jour : {energy_in_kwh} kWh")
                 send_message_by_telegram(message, TG_TOKEN, TG_CHATID)
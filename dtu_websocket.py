@@ -0,0 +1,147 @@
+## Live data pushed by OpenDTU on its /livedata websocket
+## Every message has the same layout as /api/livedata/status, usually with
+## only the inverter that just changed. Messages are merged into a local
+## copy of the live data, and the serials that changed are handed to the
+## polling loop, which then updates Domoticz right away. A connection that
+## stays open without delivering messages is reported by is_stale().
+## Requires the optional package websocket-client (pip install websocket-client)
+
+import base64
+import json
+import logging
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+logger = logging.getLogger(__name__)
+
+def build_ws_url(dtu_base_url: str):
+    """Return the websocket URL and the auth headers for the given DTU base URL."""
+    parts   = urlsplit(dtu_base_url)
+    scheme  = 'wss' if parts.scheme == 'https' else 'ws'
+    netloc  = parts.hostname + (f':{parts.port}' if parts.port else '')
+    headers = []
+    if parts.username:
+        credentials = base64.b64encode(f'{parts.username}:{parts.password or ""}'.encode()).decode()
+        headers.append(f'Authorization: Basic {credentials}')
+    return urlunsplit((scheme, netloc, parts.path.rstrip('/') + '/livedata', '', '')), headers
+
+class LiveDataFeed:
+    """Background websocket client keeping the latest live data of every inverter."""
+
+    def __init__(self, dtu_base_url: str, reconnect_delay: float = 1, reconnect_max_delay: float = 60):
+        if websocket is None:
+            raise RuntimeError('websocket ingestion requires the websocket-client package')
+        self.url, self.headers   = build_ws_url(dtu_base_url)
+        self.reconnect_delay     = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.inverters           = {}
+        self.total               = None
+        self.connected           = False
+        self.last_message        = None
+        self._changed            = set()
+        self._total_changed      = False
+        self._condition          = threading.Condition()
+        self._stop               = threading.Event()
+        self._app                = None
+        self._thread             = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='opendtu-websocket', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._app is not None:
+            self._app.close()
+        with self._condition:
+            self._condition.notify_all()
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while not self._stop.is_set():
+            opened_at = time.monotonic()
+            self._app = websocket.WebSocketApp(
+                self.url,
+                header     = self.headers,
+                on_open    = self._on_open,
+                on_message = self._on_message,
+                on_error   = self._on_error,
+                on_close   = self._on_close
+            )
+            self._app.run_forever(ping_interval=10, ping_timeout=5)
+            self._set_connected(False)
+            if self._stop.is_set():
+                break
+            # Reset the backoff after a connection that lived for a while
+            if time.monotonic() - opened_at > self.reconnect_max_delay:
+                delay = self.reconnect_delay
+            logger.warning(f'Websocket {self.url} closed, reconnecting in {delay} seconds')
+            self._stop.wait(delay)
+            delay = min(delay * 2, self.reconnect_max_delay)
+
+    def _set_connected(self, connected: bool):
+        with self._condition:
+            self.connected = connected
+            self._condition.notify_all()
+
+    def _on_open(self, app):
+        logger.info(f'Websocket {self.url} connected')
+        with self._condition:
+            # The staleness delay of a new connection starts when it opens
+            self.last_message = time.monotonic()
+        self._set_connected(True)
+
+    def _on_error(self, app, error):
+        logger.error(f'Websocket error: {error}')
+
+    def _on_close(self, app, status_code, message):
+        logger.debug(f'Websocket closed : {status_code} {message}')
+
+    def _on_message(self, app, message):
+        try:
+            live_data = json.loads(message)
+        except ValueError:
+            logger.warning('Invalid JSON received on websocket')
+            return
+        with self._condition:
+            for inverter in live_data.get('inverters') or []:
+                if 'serial' not in inverter:
+                    continue
+                serial = str(inverter['serial'])
+                # Keep the fields of a previous message that this delta does not carry
+                self.inverters[serial] = {**self.inverters.get(serial, {}), **inverter}
+                self._changed.add(serial)
+            if live_data.get('total'):
+                self.total = live_data['total']
+                self._total_changed = True
+            self.last_message = time.monotonic()
+            self._condition.notify_all()
+
+    def is_stale(self, max_age: float):
+        """True when the socket is connected but no message arrived for more than max_age seconds."""
+        with self._condition:
+            return self.connected and self.last_message is not None and time.monotonic() - self.last_message > max_age
+
+    def snapshot(self):
+        """Return the merged live data, with the same layout as /api/livedata/status."""
+        with self._condition:
+            if self.total is None and not self.inverters:
+                return None
+            return {'inverters': [dict(inverter) for inverter in self.inverters.values()], 'total': self.total}
+
+    def wait_for_changes(self, timeout: float):
+        """Wait until some inverter changed, the socket went down, or the timeout expired.
+
+        Returns the set of changed serials and whether the totals changed.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._changed or self._total_changed or not self.connected or self._stop.is_set(), timeout)
+            changed, total_changed = self._changed, self._total_changed
+            self._changed, self._total_changed = set(), False
+            return changed, total_changed
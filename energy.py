@@ -0,0 +1,156 @@
+## Local energy integration of the power samples
+## Each sample adds the energy since the previous sample of the same device
+## (trapezoidal rule) to its hourly and daily rollups, in constant time.
+## Gaps longer than max_gap seconds (restart, lost DTU) are not integrated.
+## The rollups live in the runtime state store and are persisted with it,
+## along with the DTU YieldDay and YieldTotal counters seen each day, so the
+## integrated energy can be cross-checked against the DTU. The state is only
+## marked changed when a rollup or a counter changes, not at night. The last
+## sample of each device is saved at shutdown (checkpoint), so a short
+## restart leaves no gap.
+
+import datetime
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class EnergyIntegrator:
+    """Integrate power samples per device into hourly and daily energy, in Wh."""
+
+    def __init__(self, state: dict, on_change=None, max_gap: float = 900, keep_hours: int = 48, keep_days: int = 366, clock=time.time, lock=None):
+        self.max_gap    = max_gap
+        self.keep_hours = keep_hours
+        self.keep_days  = keep_days
+        self.clock      = clock
+        self.on_change  = on_change
+        self.state      = state
+        self.hourly     = state.setdefault('hourly', {})
+        self.daily      = state.setdefault('daily', {})
+        self.counters   = state.setdefault('counters', {})
+        self._last      = dict(state.get('last', {}))
+        self._period    = (None, None, None)
+        # The lock of the state store when the state is persisted, so that a flush never sees a half update
+        self._lock      = lock or threading.Lock()
+
+    def _keys(self, timestamp: float):
+        """Hour and day keys of a timestamp, recomputed once per hour only."""
+        start, end, keys = self._period
+        if start is None or not start <= timestamp < end:
+            moment = datetime.datetime.fromtimestamp(timestamp)
+            hour = moment.replace(minute=0, second=0, microsecond=0)
+            start = hour.timestamp()
+            end = (hour + datetime.timedelta(hours=1)).timestamp()
+            keys = (hour.strftime('%Y-%m-%dT%H'), hour.strftime('%Y-%m-%d'))
+            self._period = (start, end, keys)
+        return keys
+
+    def add(self, device: str, power: float, yield_day: float = None, yield_total: float = None):
+        """Add a power sample (W), with the DTU counters of the device when known (Wh)."""
+        now = self.clock()
+        hour, day = self._keys(now)
+        changed = False
+        with self._lock:
+            last = self._last.get(device)
+            self._last[device] = [now, power]
+            if last is not None and 0 < now - last[0] <= self.max_gap:
+                energy = (last[1] + power) / 2 * (now - last[0]) / 3600
+                changed = self._add_energy(device, hour, day, energy)
+            if yield_day is not None or yield_total is not None:
+                changed = self._add_counters(device, day, yield_day, yield_total) or changed
+        if changed and self.on_change is not None:
+            self.on_change()
+
+    def checkpoint(self):
+        """Save the last sample of each device into the state, e.g. at shutdown."""
+        with self._lock:
+            self.state['last'] = {device: list(sample) for device, sample in self._last.items()}
+        if self.on_change is not None:
+            self.on_change()
+
+    def _add_energy(self, device: str, hour: str, day: str, energy: float):
+        """Returns whether a rollup changed."""
+        if energy <= 0:
+            # Nothing produced (night) : the state stays clean, a missing rollup reads as 0
+            return False
+        hours = self.hourly.setdefault(device, {})
+        if hour not in hours:
+            # Hour rollover : round the closed hours and drop the old ones
+            for key in list(hours):
+                hours[key] = round(hours[key], 1)
+            for key in sorted(hours)[:max(0, len(hours) + 1 - self.keep_hours)]:
+                del hours[key]
+            hours[hour] = 0.0
+        hours[hour] += energy
+        days = self.daily.setdefault(device, {})
+        if day not in days:
+            for key in list(days):
+                days[key] = round(days[key], 1)
+            for key in sorted(days)[:max(0, len(days) + 1 - self.keep_days)]:
+                del days[key]
+            days[day] = 0.0
+        days[day] += energy
+        return True
+
+    def _add_counters(self, device: str, day: str, yield_day: float, yield_total: float):
+        """Returns whether a counter changed."""
+        counters = self.counters.get(device)
+        before = dict(counters) if counters is not None else None
+        if counters is None or counters['date'] != day:
+            counters = self.counters[device] = {'date': day, 'yield_day': None, 'yield_total_start': yield_total, 'yield_total': yield_total}
+        # YieldDay only grows during the day, some DTU report 0 once the inverters sleep
+        if yield_day is not None and (counters['yield_day'] is None or yield_day > counters['yield_day']):
+            counters['yield_day'] = yield_day
+        if yield_total is not None:
+            if counters['yield_total_start'] is None:
+                counters['yield_total_start'] = yield_total
+            counters['yield_total'] = max(yield_total, counters['yield_total'] or 0)
+        return counters != before
+
+    def today(self):
+        return datetime.date.fromtimestamp(self.clock()).isoformat()
+
+    def day_energy(self, device: str, day: str = None):
+        """Integrated energy of a device for a day (today by default), in Wh."""
+        day = day or self.today()
+        with self._lock:
+            return self.daily.get(device, {}).get(day, 0.0)
+
+    def hour_energy(self, device: str, hour: str):
+        with self._lock:
+            return self.hourly.get(device, {}).get(hour, 0.0)
+
+    def day_summary(self, device: str, day: str = None):
+        """Integrated energy and DTU counters of a day : (integrated Wh, YieldDay Wh, YieldTotal increase Wh)."""
+        day = day or self.today()
+        with self._lock:
+            integrated = self.daily.get(device, {}).get(day, 0.0)
+            counters = self.counters.get(device)
+            if counters is None or counters['date'] != day:
+                return integrated, None, None
+            total_delta = None
+            if counters['yield_total'] is not None and counters['yield_total_start'] is not None:
+                total_delta = counters['yield_total'] - counters['yield_total_start']
+            return integrated, counters['yield_day'], total_delta
+
+    def cross_check(self, device: str, day: str = None, tolerance: float = 0.1, min_difference: float = 50):
+        """Compare the integrated energy with the DTU YieldDay (else the YieldTotal increase), returns the difference in Wh or None."""
+        integrated, yield_day, total_delta = self.day_summary(device, day)
+        reported = yield_day if yield_day is not None else total_delta
+        if reported is None:
+            return None
+        difference = integrated - reported
+        if abs(difference) > max(min_difference, tolerance * reported):
+            logger.warning(f'Energy of {device} : {integrated:0.0f} Wh integrated, {reported:0.0f} Wh reported by the DTU')
+        return difference
+
+    def day_energy(self, device: str, day: str = None, tolerance: float = 0.1, min_difference: float = 50):
+        """Energy of a day in Wh : the DTU YieldDay when it passes the cross-check, else the integrated energy."""
+        integrated, yield_day, _ = self.day_summary(device, day)
+        if yield_day is None:
+            return integrated
+        difference = self.cross_check(device, day, tolerance, min_difference)
+        if difference is not None and abs(difference) > max(min_difference, tolerance * yield_day):
+            return integrated
+        return yield_day
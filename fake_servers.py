@@ -0,0 +1,300 @@
+## Local stand-ins for OpenDTU and Domoticz, used by benchmark.py
+## Both servers answer with a configurable latency, jitter and error rate,
+## and count the requests they receive. The fake OpenDTU also serves the
+## /livedata websocket on the same port, pushing one inverter per message,
+## with switches to drop the connections or to stop pushing (stale data).
+
+import base64
+import hashlib
+import json
+import math
+import random
+import select
+import socket
+import struct
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Key suffix of the websocket handshake (RFC 6455)
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+def _recv_exactly(connection, size: int):
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('websocket closed by the client')
+        data += chunk
+    return data
+
+def read_frame(connection):
+    """Read one (masked) client frame, returns (opcode, payload)."""
+    first, second = _recv_exactly(connection, 2)
+    length = second & 0x7f
+    if length == 126:
+        length = struct.unpack('!H', _recv_exactly(connection, 2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', _recv_exactly(connection, 8))[0]
+    mask = _recv_exactly(connection, 4) if second & 0x80 else b'\0\0\0\0'
+    payload = _recv_exactly(connection, length)
+    return first & 0x0f, bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+def write_frame(connection, opcode: int, payload: bytes = b''):
+    """Write one final, unmasked server frame."""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    connection.sendall(header + payload)
+
+class FakeServer:
+    """Threaded HTTP server answering with a delay, and failing at error_rate."""
+
+    def __init__(self, latency: float = 0, jitter: float = 0, error_rate: float = 0, seed: int = None, port: int = 0):
+        self.latency    = latency
+        self.jitter     = jitter
+        self.error_rate = error_rate
+        self.port       = port
+        self.requests   = Counter()
+        self.errors     = 0
+        self._random    = random.Random(seed)
+        self._lock      = threading.Lock()
+        self._server    = None
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, avoid the delayed ACK stall on keep-alive connections
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                fake._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+            self.errors = 0
+
+    def _handle(self, handler):
+        url = urlsplit(handler.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self._lock:
+            delay = max(0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            failed = self._random.random() < self.error_rate
+        time.sleep(delay)
+        try:
+            kind, body = self.route(url.path, query)
+        except (KeyError, ValueError):
+            kind, body = 'unknown', None
+        with self._lock:
+            self.requests[kind] += 1
+            if failed:
+                self.errors += 1
+        if body is None or failed:
+            status, content = (404 if body is None else 500), b''
+        else:
+            status, content = 200, json.dumps(body).encode()
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def route(self, path: str, query: dict):
+        """Return the request kind and the JSON body, or None for a 404."""
+        raise NotImplementedError
+
+class FakeOpenDTU(FakeServer):
+    """OpenDTU with /api/livedata/status, ?inv=, /api/inverter/list and the /livedata websocket.
+
+    Serials added to unreachable are reported asleep (not reachable, stale data),
+    the ?inv= requests of the serials in broken fail with a 404.
+    The websocket pushes the next inverter, with the totals, every push_interval
+    seconds. drop_websockets() closes the open connections, and nothing is pushed
+    while websocket_stale is set.
+    """
+
+    def __init__(self, inverters: int = 4, producing: bool = True, full_status: bool = True, max_power: float = 400, serial_prefix: str = '1161',
+                 push_interval: float = 0.05, **kwargs):
+        super().__init__(**kwargs)
+        self.serials         = [f'{serial_prefix}{index:08d}' for index in range(inverters)]
+        self.producing       = producing
+        self.full_status     = full_status
+        self.max_power       = max_power
+        self.unreachable     = set()
+        self.broken          = set()
+        self.push_interval   = push_interval
+        self.websocket_stale = False
+        self.pushed          = 0
+        self._generation     = 0
+        self._started_at     = time.time()
+
+    def inverter_payload(self, index: int, serial: str, full: bool = True):
+        elapsed = time.time() - self._started_at
+        producing = self.producing and serial not in self.unreachable
+        power = round(self.max_power * (0.6 + 0.1 * math.sin(elapsed / 60 + index)), 1) if producing else 0
+        yield_day = round(elapsed * power / 3600, 0)
+        inverter = {
+            'serial': serial,
+            'name': f'Inverter {index + 1}',
+            'order': index,
+            'data_age': 3600 if serial in self.unreachable else 1,
+            'poll_enabled': True,
+            'reachable': producing,
+            'producing': producing,
+            'limit_relative': 100,
+            'limit_absolute': self.max_power
+        }
+        if full:
+            inverter['AC'] = {'0': {
+                'Power': {'v': round(power * 0.96, 1), 'u': 'W', 'd': 1},
+                'Voltage': {'v': 231.2, 'u': 'V', 'd': 1},
+                'Current': {'v': round(power * 0.96 / 231.2, 2), 'u': 'A', 'd': 2},
+                'Frequency': {'v': 50.0, 'u': 'Hz', 'd': 2}
+            }}
+            inverter['DC'] = {str(channel): {
+                'name': {'u': f'Panel {channel + 1}'},
+                'Power': {'v': round(power / 2, 1), 'u': 'W', 'd': 1},
+                'Voltage': {'v': 34.1, 'u': 'V', 'd': 1},
+                'Current': {'v': round(power / 2 / 34.1, 2), 'u': 'A', 'd': 2},
+                'YieldDay': {'v': yield_day / 2, 'u': 'Wh', 'd': 0},
+                'YieldTotal': {'v': 1234.5 / 2, 'u': 'kWh', 'd': 3}
+            } for channel in range(2)}
+            inverter['INV'] = {'0': {
+                'Power DC': {'v': power, 'u': 'W', 'd': 1},
+                'YieldDay': {'v': yield_day, 'u': 'Wh', 'd': 0},
+                'YieldTotal': {'v': 1234.5, 'u': 'kWh', 'd': 3},
+                'Temperature': {'v': 32.5, 'u': '°C', 'd': 1},
+                'Efficiency': {'v': 96.0, 'u': '%', 'd': 3}
+            }}
+        return inverter
+
+    def total_payload(self, inverters: list):
+        return {
+            'Power': {'v': sum(inverter['INV']['0']['Power DC']['v'] for inverter in inverters), 'u': 'W', 'd': 1},
+            'YieldDay': {'v': sum(inverter['INV']['0']['YieldDay']['v'] for inverter in inverters), 'u': 'Wh', 'd': 0},
+            'YieldTotal': {'v': sum(inverter['INV']['0']['YieldTotal']['v'] for inverter in inverters), 'u': 'kWh', 'd': 3}
+        }
+
+    def drop_websockets(self):
+        """Close the open websocket connections, the clients have to reconnect."""
+        with self._lock:
+            self._generation += 1
+
+    def _handle(self, handler):
+        if urlsplit(handler.path).path == '/livedata' and handler.headers.get('Upgrade', '').lower() == 'websocket':
+            self._serve_websocket(handler)
+        else:
+            super()._handle(handler)
+
+    def _serve_websocket(self, handler):
+        key = handler.headers.get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        handler.send_response(101, 'Switching Protocols')
+        handler.send_header('Upgrade', 'websocket')
+        handler.send_header('Connection', 'Upgrade')
+        handler.send_header('Sec-WebSocket-Accept', accept)
+        handler.end_headers()
+        handler.wfile.flush()
+        handler.close_connection = True
+        connection = handler.connection
+        with self._lock:
+            self.requests['websocket'] += 1
+            generation = self._generation
+        index = 0
+        next_push = time.monotonic()
+        try:
+            while generation == self._generation:
+                # Answer the ping and close frames of the client between two pushes
+                readable, _, _ = select.select([connection], [], [], max(0, next_push - time.monotonic()))
+                if readable:
+                    opcode, payload = read_frame(connection)
+                    if opcode == 0x8:
+                        write_frame(connection, 0x8, payload[:2])
+                        return
+                    if opcode == 0x9:
+                        write_frame(connection, 0xa, payload)
+                    continue
+                next_push = time.monotonic() + self.push_interval
+                if self.websocket_stale or not self.serials:
+                    continue
+                index = (index + 1) % len(self.serials)
+                full = [self.inverter_payload(position, serial) for position, serial in enumerate(self.serials)]
+                message = {'inverters': [full[index]], 'total': self.total_payload(full), 'hints': {}}
+                write_frame(connection, 0x1, json.dumps(message).encode())
+                with self._lock:
+                    self.pushed += 1
+            # Dropped : close without a close frame, like a DTU reboot
+            connection.shutdown(socket.SHUT_RDWR)
+        except (ConnectionError, OSError):
+            pass
+
+    def route(self, path: str, query: dict):
+        if path == '/api/livedata/status' and 'inv' in query:
+            if query['inv'] in self.broken:
+                return 'inverter', None
+            index = self.serials.index(query['inv'])
+            return 'inverter', {'inverters': [self.inverter_payload(index, query['inv'])]}
+        if path == '/api/livedata/status':
+            inverters = [self.inverter_payload(index, serial, self.full_status) for index, serial in enumerate(self.serials)]
+            full = [self.inverter_payload(index, serial) for index, serial in enumerate(self.serials)]
+            return 'status', {'inverters': inverters, 'total': self.total_payload(full), 'hints': {}}
+        if path == '/api/inverter/list':
+            return 'list', {'inverter': [{'serial': serial, 'name': f'Inverter {index + 1}', 'order': index} for index, serial in enumerate(self.serials)]}
+        return 'unknown', None
+
+class FakeDomoticz(FakeServer):
+    """Domoticz json.htm with the udevice, createdevice, setused and getdevices commands."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.devices  = {}
+        self.next_idx = 1
+
+    def route(self, path: str, query: dict):
+        if path != '/json.htm':
+            return 'unknown', None
+        param = query.get('param')
+        if param == 'udevice':
+            with self._lock:
+                self.devices.setdefault(query['idx'], {})['svalue'] = query.get('svalue')
+            return 'udevice', {'status': 'OK', 'title': 'Update Device'}
+        if param == 'createdevice':
+            with self._lock:
+                idx = str(self.next_idx)
+                self.next_idx += 1
+                self.devices[idx] = {'Name': query.get('sensorname'), 'HardwareID': int(query.get('idx', 1))}
+            return 'createdevice', {'status': 'OK', 'title': 'CreateSensor', 'idx': idx}
+        if param == 'getdevices':
+            with self._lock:
+                devices = [{'idx': idx, 'Name': device.get('Name', ''), 'HardwareID': device.get('HardwareID', 1)} for idx, device in self.devices.items()]
+            return 'getdevices', {'status': 'OK', 'result': devices}
+        if param == 'setused':
+            with self._lock:
+                self.devices.setdefault(query['idx'], {})['Name'] = query.get('name')
+            return 'setused', {'status': 'OK', 'title': 'SetUsed'}
+        return 'unknown', {'status': 'ERR'}
@@ -0,0 +1,84 @@
+## Several OpenDTU gateways polled from one process
+## Each gateway keeps its own health state and the last totals it reported.
+## The totals of all gateways are summed, so that the global Domoticz
+## devices show the whole installation.
+
+import datetime
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class Gateway:
+    """One OpenDTU unit and its health state."""
+
+    def __init__(self, name: str, base_url: str, down_after: int = 3, clock=time.monotonic):
+        self.name                 = name
+        self.base_url             = base_url
+        self.down_after           = down_after
+        self.clock                = clock
+        self.healthy              = True
+        self.consecutive_failures = 0
+        self.total_failures       = 0
+        self.last_success         = None
+        self.last_total           = None
+        self.last_total_date      = None
+
+    def record(self, live_data):
+        """Update the health state with the result of a /api/livedata/status request."""
+        if live_data is None:
+            self.consecutive_failures += 1
+            self.total_failures += 1
+            if self.healthy and self.consecutive_failures >= self.down_after:
+                self.healthy = False
+                logger.warning(f'Gateway {self.name} ({self.base_url}) is down after {self.consecutive_failures} failures')
+            return
+        if not self.healthy:
+            logger.info(f'Gateway {self.name} ({self.base_url}) is back after {self.consecutive_failures} failures')
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.last_success = self.clock()
+        if live_data.get('total'):
+            self.last_total = live_data['total']
+            self.last_total_date = datetime.date.today().isoformat()
+
+def load_gateways(global_config: dict):
+    """Build the gateways from global_config, a single dtu_base_url is a gateway named 'default'."""
+    entries = global_config.get('gateways') or [{'name': 'default', 'dtu_base_url': global_config.get('dtu_base_url')}]
+    return [Gateway(entry['name'], entry['dtu_base_url'], entry.get('down_after', 3)) for entry in entries]
+
+def _value(total: dict, field: str):
+    return float((total.get(field) or {}).get('v') or 0)
+
+def aggregate_live_data(gateways: list, live_datas: list):
+    """Merge the live data of every gateway into one payload with the /api/livedata/status layout.
+
+    Returns None when no gateway answered. The yields of a gateway which did not
+    answer come from its last totals, so that the counters never go backwards,
+    but its power is not counted. Its YieldDay is only counted when those totals
+    were received today, the YieldTotal counter is always counted.
+    """
+    if all(live_data is None for live_data in live_datas):
+        return None
+    if len(live_datas) == 1:
+        return live_datas[0]
+    inverters = []
+    today = datetime.date.today().isoformat()
+    power = yield_day = yield_total = 0
+    for gateway, live_data in zip(gateways, live_datas):
+        if live_data is not None:
+            inverters += live_data.get('inverters') or []
+            if live_data.get('total'):
+                power += _value(live_data['total'], 'Power')
+        if gateway.last_total:
+            if gateway.last_total_date == today:
+                yield_day += _value(gateway.last_total, 'YieldDay')
+            yield_total += _value(gateway.last_total, 'YieldTotal')
+    return {
+        'inverters': inverters,
+        'total': {
+            'Power': {'v': power, 'u': 'W'},
+            'YieldDay': {'v': yield_day, 'u': 'Wh'},
+            'YieldTotal': {'v': yield_total, 'u': 'kWh'}
+        }
+    }
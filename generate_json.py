@@ -1,12 +1,18 @@
 ## Read Devices from OpenDTU
-## Create Domoticz dummy devices and get IDX
-## Generate data.json with the required infos
+## Create the missing Domoticz dummy devices and get IDX
+## Generate data.json with the required infos, or merge them into the existing one
 ## Then you can use run_v2.py
+## Running it again (e.g. after adding an inverter) reuses the existing devices:
+## only the missing ones are created, and the existing settings of data.json are kept.
 
-import requests
+import config
+import dataclasses
+import http_sessions
 import logging
 import json
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 # Base URLs and configuration
 domoticz_base_url  = "http://192.168.15.100"       ## MODIFY THE VALUE, add user/pass if needed
@@ -21,20 +27,55 @@ dtu_base_login     = 'admin'
 dtu_base_password  = 'password'                    ## MODIFY THE VALUE
 dtu_base_url       = f"http://{dtu_base_login}:{dtu_base_password}@{dtu_base_IP}"
 sleep_duration     = 3                             ## MODIFY THE VALUE IF NEEDED
+max_workers        = 8                             ## Devices created at the same time
 log_format         = "%(asctime)s - %(name)s - %(levelname)s - %(message)s\n(%(filename)s:%(lineno)d)"
 logging.basicConfig(format=log_format)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Fetch inverter details
-inverters_list = requests.get(f'{dtu_base_url}/api/inverter/list', timeout=1)
-inverters_data = inverters_list.json()
+# Pooled keep-alive sessions, with the timeouts and retry policy of each endpoint
+dtu_session        = http_sessions.create_session('dtu')
+domoticz_session   = http_sessions.create_session('domoticz')
+
+def get_inverters():
+    """Fetch the inverter list from OpenDTU."""
+    inverters_list = dtu_session.get(f'{dtu_base_url}/api/inverter/list')
+    inverters_list.raise_for_status()
+    return inverters_list.json()['inverter']
+
+def get_existing_devices():
+    """Fetch all Domoticz devices once, and index them by IDX and by name."""
+    response = domoticz_session.get(f"{domoticz_base_url}/json.htm?type=command&param=getdevices&used=all")
+    response.raise_for_status()
+    result = response.json()
+    if result.get('status') != 'OK':
+        raise RuntimeError(f"Cannot list Domoticz devices : {result.get('status')}")
+    devices_by_idx = {}
+    devices_by_name = {}
+    for device in result.get('result', []):
+        devices_by_idx[str(device['idx'])] = device
+        # Only reuse devices by name when they belong to our dummy hardware
+        if str(device.get('HardwareID', dummy_HW_IDX)) == str(dummy_HW_IDX):
+            devices_by_name.setdefault(device['Name'], str(device['idx']))
+    return devices_by_idx, devices_by_name
+
+def load_existing_config():
+    if not os.path.exists(json_filename):
+        return {}
+    with open(json_filename, 'r') as json_file:
+        return json.load(json_file)
+
+def find_device(name, known_idx, devices_by_idx, devices_by_name):
+    """IDX of an existing device: the one already in data.json if it still exists, else the one with this name."""
+    if known_idx is not None and str(known_idx) in devices_by_idx:
+        return str(known_idx)
+    return devices_by_name.get(name)
 
 def create_dummy_device(sensor_name, device_type, device_subtype):
     """Create a dummy device in Domoticz and return its IDX."""
     update_url = f"{domoticz_base_url}/json.htm?type=command&param=createdevice&idx={dummy_HW_IDX}&sensorname={sensor_name}&devicetype={device_type}&devicesubtype={device_subtype}"
     logger.debug(update_url)
-    response = requests.get(update_url)
+    response = domoticz_session.get(update_url)
     if response.status_code == 200:
         result = response.json()
         if result.get('status') == 'OK':
@@ -48,45 +89,9 @@ def create_dummy_device(sensor_name, device_type, device_subtype):
         logger.error(f"Failed to create device {sensor_name}: {response.status_code}")
         return None
 
-def generate_data_json(devices_info, global_solar_idx, global_solar_historic_idx):
-    logger.info('Generate JSON File')
-    """Generate the data.json file with the required format."""
-    solar_units = {device['serial']: {
-        "idx": device['idx'],
-        "name": device['name'],
-        "max_power": 400,
-        "failures": 0
-    } for device in devices_info}
-    
-    data = {
-        "solar_units": solar_units,
-        "telegram": {
-            "token": telegram_token,
-            "chat_id": telegram_chat_id
-        },
-        "global_solar": {
-            "idx": global_solar_idx,
-            "name": sensor_name_global,
-            "failures": 0
-        },
-        "global_solar_historic": {
-            "idx": global_solar_historic_idx,
-            "name": sensor_name_P1,
-            "failures": 0
-        },
-        "global_config": {
-            "dtu_base_url": f'http://{dtu_base_IP}',
-            "domoticz_base_url": domoticz_base_url,
-            "sleep_duration": sleep_duration
-        }
-    }
-    
-    with open(json_filename, 'w') as json_file:
-        json.dump(data, json_file, indent=4)
-
 def update_sensor(idx, sensor_name):
     update_url = f"{domoticz_base_url}/json.htm?type=command&param=setused&idx={idx}&name={sensor_name}&switchtype=4&used=true&EnergyMeterMode=1"
-    response = requests.get(update_url)
+    response = domoticz_session.get(update_url)
     if response.status_code == 200:
         result = response.json()
         if result.get('status') == 'OK':
@@ -99,42 +104,118 @@ def update_sensor(idx, sensor_name):
         logger.error(f"Failed to update device {sensor_name}: {response.status_code}")
         return None
 
-def main():
-    devices_info = []
-    # If json_filename already exists, ask if user wants to overwrite it
-    if os.path.exists(json_filename):
-        logger.warning('File already exists!')
-        answer = input('Do you want to overwrite it? [Y/n]').strip() or "Y"
-        #answer = input()
-        if not (answer == 'Y' or answer == 'y'):
-            logger.info('Aborting')
-            exit(0)
+def provision_device(device):
+    """Create one missing device, and set it as used when needed. Returns its IDX."""
+    idx = create_dummy_device(device['name'], device['type'], device['subtype'])
+    if idx is not None and device['set_used']:
+        logger.info(update_sensor(idx, device['name']))
+    return idx
+
+def default_global_config():
+    """global_config of a new data.json : every key of config.GlobalConfig, with its default."""
+    settings = {field.name: field.default for field in dataclasses.fields(config.GlobalConfig) if field.name != 'gateways'}
+    settings.update({
+        "dtu_base_url": f'http://{dtu_base_IP}',
+        "domoticz_base_url": domoticz_base_url,
+        "sleep_duration": sleep_duration,
+        "single_request": True,
+        "write_deadband": 1
+    })
+    return settings
+
+def default_data_json():
+    """Settings of a new data.json."""
+    return {
+        "solar_units": {},
+        "telegram": {
+            "token": telegram_token,
+            "chat_id": telegram_chat_id,
+            "coalesce_window": 1,
+            "min_interval": 1,
+            "max_retries": 5
+        },
+        "global_solar": {
+            "name": sensor_name_global
+        },
+        "global_solar_historic": {
+            "name": sensor_name_P1
+        },
+        "http": http_sessions.DEFAULT_SETTINGS,
+        "global_config": default_global_config()
+    }
+
+def merge_data_json(existing, devices_info, global_solar_idx, global_solar_historic_idx):
+    """Merge the devices into the existing settings, the existing values win."""
+    data = default_data_json()
+    for section, value in existing.items():
+        if isinstance(value, dict) and isinstance(data.get(section), dict):
+            data[section] = {**data[section], **value}
         else:
-            logger.info('Overwriting existing file')
-            os.remove(json_filename)
+            data[section] = value
+    solar_units = dict(existing.get('solar_units', {}))
+    for device in devices_info:
+        unit = {"name": device['name'], "max_power": 400, **solar_units.get(device['serial'], {})}
+        unit['idx'] = device['idx']
+        solar_units[device['serial']] = unit
+    data['solar_units'] = solar_units
+    data['global_solar']['idx'] = global_solar_idx
+    data['global_solar_historic']['idx'] = global_solar_historic_idx
+    return data
 
-    # Create Individual Inverters from OpenDTU
-    for inverter in inverters_data['inverter']:
-        sensor_name = inverter['name']
-        serial_number = inverter['serial']
+def write_data_json(data):
+    """Write data.json through a temporary file, so that it is never left half written."""
+    logger.info('Generate JSON File')
+    directory = os.path.dirname(os.path.abspath(json_filename))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.data-', suffix='.tmp')
+    with os.fdopen(fd, 'w') as json_file:
+        json.dump(data, json_file, indent=4)
+    os.replace(tmp_path, json_filename)
+
+def main():
+    existing = load_existing_config()
+    if existing:
+        logger.info(f'{json_filename} already exists, merging into it')
+    devices_by_idx, devices_by_name = get_existing_devices()
+    logger.info(f'{len(devices_by_idx)} existing Domoticz devices')
+
+    # Every device we need, with the IDX of the matching existing device if any
+    wanted = []
+    for inverter in get_inverters():
+        serial_number = str(inverter['serial'])
+        unit = existing.get('solar_units', {}).get(serial_number, {})
+        sensor_name = unit.get('name', inverter['name'])
         logger.info(f'Discovered OpenDTU Inverter : {sensor_name}')
-        idx = create_dummy_device(sensor_name, 243, 29)
-        if idx is not None:
-            devices_info.append({'name': sensor_name, 'serial': serial_number, 'idx': idx})
-            update_result = update_sensor(idx, sensor_name)
-            logger.info(update_result)
-
-    # Create P1 Meter for history
-    global_solar_historic_idx = create_dummy_device(sensor_name_P1, 250, 1)
-    
-    # Create Global Solar Dummy for Instant Value
-    global_solar_idx = create_dummy_device(sensor_name_global, 243, 29)
-    if global_solar_idx is not None:
-        update_result = update_sensor(global_solar_idx, sensor_name_global)
-        logger.info(update_result)
+        wanted.append({'key': serial_number, 'name': sensor_name, 'type': 243, 'subtype': 29, 'set_used': True,
+                       'idx': find_device(sensor_name, unit.get('idx'), devices_by_idx, devices_by_name)})
+    # P1 Meter for history
+    historic = existing.get('global_solar_historic', {})
+    historic_name = historic.get('name', sensor_name_P1)
+    wanted.append({'key': 'global_solar_historic', 'name': historic_name, 'type': 250, 'subtype': 1, 'set_used': False,
+                   'idx': find_device(historic_name, historic.get('idx'), devices_by_idx, devices_by_name)})
+    # Global Solar Dummy for Instant Value
+    solar = existing.get('global_solar', {})
+    solar_name = solar.get('name', sensor_name_global)
+    wanted.append({'key': 'global_solar', 'name': solar_name, 'type': 243, 'subtype': 29, 'set_used': True,
+                   'idx': find_device(solar_name, solar.get('idx'), devices_by_idx, devices_by_name)})
+
+    for device in wanted:
+        if device['idx'] is not None:
+            logger.info(f"Reusing Domoticz device {device['name']} : IDX {device['idx']}")
+
+    # Create only the missing devices, concurrently
+    missing = [device for device in wanted if device['idx'] is None]
+    logger.info(f'Creating {len(missing)} missing devices')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for device, idx in zip(missing, executor.map(provision_device, missing)):
+            device['idx'] = idx
+
+    idx_by_key = {device['key']: device['idx'] for device in wanted}
+    devices_info = [{'name': device['name'], 'serial': device['key'], 'idx': device['idx']}
+                    for device in wanted[:-2] if device['idx'] is not None]
 
     # Generate the data.json file
-    generate_data_json(devices_info, global_solar_idx, global_solar_historic_idx)
+    data = merge_data_json(existing, devices_info, idx_by_key['global_solar'], idx_by_key['global_solar_historic'])
+    write_data_json(data)
 
     # Output the devices info list
     logger.info(f"Devices Info: {devices_info}")
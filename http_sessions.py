@@ -0,0 +1,90 @@
+## Pooled HTTP sessions, one per endpoint (DTU, Domoticz, Telegram)
+## Connections are kept alive between cycles, every request gets the
+## connect / read timeouts of its endpoint, and failed requests are
+## retried a bounded number of times with a jittered exponential backoff.
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Default settings for each endpoint, any key can be overridden in the "http" section of data.json
+DEFAULT_SETTINGS = {
+    'dtu': {
+        'connect_timeout': 1,
+        'read_timeout': 1,
+        'retries': 1,
+        'backoff_factor': 0.1,
+        'backoff_jitter': 0.1,
+        'pool_size': 10
+    },
+    'domoticz': {
+        'connect_timeout': 1,
+        'read_timeout': 3,
+        'retries': 2,
+        'backoff_factor': 0.2,
+        'backoff_jitter': 0.2,
+        'pool_size': 10
+    },
+    'telegram': {
+        'connect_timeout': 3,
+        'read_timeout': 10,
+        'retries': 3,
+        'backoff_factor': 1,
+        'backoff_jitter': 1,
+        'pool_size': 2
+    }
+}
+
+class EndpointSession(requests.Session):
+    """Session which applies the endpoint timeouts when none is given."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+def build_retry(settings: dict):
+    params = dict(
+        total            = settings['retries'],
+        connect          = settings['retries'],
+        read             = settings['retries'],
+        status           = settings['retries'],
+        backoff_factor   = settings['backoff_factor'],
+        status_forcelist = (500, 502, 503, 504),
+        allowed_methods  = frozenset(['GET']),
+        raise_on_status  = False
+    )
+    try:
+        return Retry(backoff_jitter=settings['backoff_jitter'], **params)
+    except TypeError:
+        # urllib3 < 2.0 has no jitter support
+        return Retry(**params)
+
+def create_session(endpoint: str, overrides: dict = None, hosts: int = 1):
+    """Create a keep-alive session for the given endpoint ('dtu', 'domoticz' or 'telegram').
+
+    hosts is the number of servers the session talks to, each one keeps its own connection pool.
+    """
+    settings = dict(DEFAULT_SETTINGS[endpoint])
+    settings.update(overrides or {})
+    session = EndpointSession(timeout=(settings['connect_timeout'], settings['read_timeout']))
+    adapter = HTTPAdapter(
+        max_retries      = build_retry(settings),
+        pool_connections = max(1, hosts),
+        pool_maxsize     = settings['pool_size']
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def create_sessions(http_config: dict = None, hosts: dict = None):
+    """Create one session per endpoint from the "http" section of data.json.
+
+    hosts gives the number of servers of an endpoint, such as the DTU gateways (1 by default).
+    """
+    http_config = http_config or {}
+    hosts       = hosts or {}
+    return {endpoint: create_session(endpoint, http_config.get(endpoint), hosts.get(endpoint, 1)) for endpoint in DEFAULT_SETTINGS}
@@ -0,0 +1,125 @@
+## Parser for the OpenDTU live data payload (/api/livedata/status and the websocket)
+## The fields to read are declared once in the schemas below and compiled
+## into key tuples at import. Each payload is then parsed in a single pass
+## into compact slotted records covering every AC, DC and INV channel.
+## Missing fields are None instead of a KeyError.
+
+# Record attribute -> OpenDTU field name, for each channel type
+AC_FIELDS = (
+    ('power', 'Power'),
+    ('voltage', 'Voltage'),
+    ('current', 'Current'),
+    ('frequency', 'Frequency'),
+    ('power_factor', 'PowerFactor'),
+    ('reactive_power', 'ReactivePower')
+)
+DC_FIELDS = (
+    ('power', 'Power'),
+    ('voltage', 'Voltage'),
+    ('current', 'Current'),
+    ('yield_day', 'YieldDay'),
+    ('yield_total', 'YieldTotal'),
+    ('irradiation', 'Irradiation')
+)
+INV_FIELDS = (
+    ('power_dc', 'Power DC'),
+    ('yield_day', 'YieldDay'),
+    ('yield_total', 'YieldTotal'),
+    ('temperature', 'Temperature'),
+    ('efficiency', 'Efficiency')
+)
+TOTAL_FIELDS = (
+    ('power', 'Power'),
+    ('yield_day', 'YieldDay'),
+    ('yield_total', 'YieldTotal')
+)
+
+class Record:
+    __slots__ = ()
+
+    def __repr__(self):
+        values = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({values})'
+
+def _compile(class_name: str, fields: tuple, extra: tuple = ()):
+    """Build a slotted record class and the tuple of payload keys it reads, in order."""
+    names = tuple(name for name, _ in fields)
+    record_class = type(class_name, (Record,), {'__slots__': extra + names})
+    return record_class, tuple(key for _, key in fields)
+
+AcChannel, _AC_KEYS       = _compile('AcChannel', AC_FIELDS)
+DcChannel, _DC_KEYS       = _compile('DcChannel', DC_FIELDS, extra=('name',))
+InvChannel, _INV_KEYS     = _compile('InvChannel', INV_FIELDS)
+TotalRecord, _TOTAL_KEYS  = _compile('TotalRecord', TOTAL_FIELDS)
+
+class InverterRecord(Record):
+    __slots__ = ('serial', 'name', 'producing', 'reachable', 'data_age', 'ac', 'dc', 'inv')
+
+class LiveDataRecord(Record):
+    __slots__ = ('inverters', 'total')
+
+def _values(group: dict, keys: tuple):
+    values = []
+    append = values.append
+    for key in keys:
+        field = group.get(key)
+        append(field.get('v') if field.__class__ is dict else None)
+    return values
+
+def _fill(record, names, values):
+    for name, value in zip(names, values):
+        setattr(record, name, value)
+    return record
+
+def _channels(groups, record_class, keys: tuple, with_name: bool = False):
+    """Parse the channels of one type, ordered by channel number."""
+    if groups.__class__ is not dict:
+        return ()
+    channels = []
+    names = record_class.__slots__[1:] if with_name else record_class.__slots__
+    for channel in sorted(groups, key=lambda number: int(number) if number.isdigit() else 0):
+        group = groups[channel]
+        if group.__class__ is not dict:
+            continue
+        record = _fill(record_class.__new__(record_class), names, _values(group, keys))
+        if with_name:
+            record.name = (group.get('name') or {}).get('u')
+        channels.append(record)
+    return tuple(channels)
+
+def parse_inverter(inverter: dict):
+    """Parse one entry of the 'inverters' array."""
+    record           = InverterRecord()
+    record.serial    = str(inverter['serial']) if 'serial' in inverter else None
+    record.name      = inverter.get('name')
+    record.producing = inverter.get('producing')
+    record.reachable = inverter.get('reachable')
+    record.data_age  = inverter.get('data_age')
+    record.ac        = _channels(inverter.get('AC'), AcChannel, _AC_KEYS)
+    record.dc        = _channels(inverter.get('DC'), DcChannel, _DC_KEYS, with_name=True)
+    record.inv       = _channels(inverter.get('INV'), InvChannel, _INV_KEYS)
+    return record
+
+def parse_total(total):
+    if total.__class__ is not dict:
+        return None
+    return _fill(TotalRecord.__new__(TotalRecord), TotalRecord.__slots__, _values(total, _TOTAL_KEYS))
+
+def parse_live_data(live_data):
+    """Parse a whole payload, returns None for None."""
+    if live_data is None:
+        return None
+    record = LiveDataRecord()
+    record.inverters = {}
+    for inverter in live_data.get('inverters') or []:
+        if inverter.__class__ is dict and 'serial' in inverter:
+            parsed = parse_inverter(inverter)
+            record.inverters[parsed.serial] = parsed
+    record.total = parse_total(live_data.get('total'))
+    return record
+
+def inverter_power(record):
+    """DC power and daily yield of channel INV 0, as used for the Domoticz devices (None when missing)."""
+    if not record.inv:
+        return None, None
+    return record.inv[0].power_dc, record.inv[0].yield_day
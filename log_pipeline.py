@@ -0,0 +1,169 @@
+## Non-blocking logging for run_v2.py
+## Records are put in a queue by the polling threads and written to the
+## console by a QueueListener thread, so log I/O never delays a cycle.
+## Identical warnings repeated within rate_limit seconds are dropped before
+## they reach the queue, and counted in the next one written. The counts of
+## a message that did not recur are written by the listener once its window
+## expired, and all of them when the pipeline stops. The output is colored
+## text, or one JSON object per line.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+class ColorFormatter(logging.Formatter):
+    """Text output with a color per level, the formatters are built once."""
+
+    grey     = "\x1b[38;20m"
+    yellow   = "\x1b[33;20m"
+    red      = "\x1b[31;20m"
+    bold_red = "\x1b[31;1m"
+    reset    = "\x1b[0m"
+    OKBLUE   = '\033[94m'
+    OKCYAN   = '\033[96m'
+    OKGREEN  = '\033[92m'
+    FORMAT   = "%(asctime)s - %(name)s - %(levelname)s - %(message)s\t(%(filename)s:%(lineno)d)"
+
+    COLORS = {
+        logging.DEBUG: OKBLUE,
+        logging.INFO: OKCYAN,
+        logging.WARNING: yellow,
+        logging.ERROR: red,
+        logging.CRITICAL: bold_red
+    }
+
+    def __init__(self):
+        super().__init__(self.FORMAT)
+        self.formatters = {level: logging.Formatter(color + self.FORMAT + self.reset) for level, color in self.COLORS.items()}
+
+    def format(self, record):
+        formatter = self.formatters.get(record.levelno)
+        if formatter is None:
+            return super().format(record)
+        return formatter.format(record)
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage().strip(),
+            'source': f'{record.filename}:{record.lineno}'
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class RateLimitFilter(logging.Filter):
+    """Let an identical record of level or above through once per interval, and count the others."""
+
+    def __init__(self, interval: float = 300, level: int = logging.WARNING, max_keys: int = 1000, clock=time.monotonic):
+        super().__init__()
+        self.interval = interval
+        self.level    = level
+        self.max_keys = max_keys
+        self.clock    = clock
+        self._seen    = {}
+        self._lock    = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.level or self.interval <= 0:
+            return True
+        key = (record.name, record.levelno, record.getMessage())
+        now = self.clock()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self.interval:
+                seen[1] += 1
+                return False
+            if len(self._seen) >= self.max_keys:
+                # Forget the messages which did not repeat recently
+                self._seen = {old_key: value for old_key, value in self._seen.items() if now - value[0] < self.interval}
+            self._seen[key] = [now, 0, record]
+        if seen is not None and seen[1]:
+            record.msg = self._repeated(key[2], seen[1], now - seen[0])
+            record.args = None
+        return True
+
+    @staticmethod
+    def _repeated(message: str, count: int, elapsed: float):
+        return f'{message} (repeated {count} more times in the last {elapsed:0.0f} s)'
+
+    def flush(self, force: bool = False):
+        """Return a record with the count of each message suppressed in a window which expired, or in any window when force."""
+        now = self.clock()
+        summaries = []
+        with self._lock:
+            for key, seen in list(self._seen.items()):
+                expired = now - seen[0] >= self.interval
+                if seen[1] and (expired or force):
+                    first = seen[2]
+                    summaries.append(logging.LogRecord(first.name, first.levelno, first.pathname, first.lineno,
+                                                       self._repeated(key[2], seen[1], now - seen[0]), None, None, first.funcName))
+                    seen[1] = 0
+                if expired:
+                    del self._seen[key]
+        return summaries
+
+class RateLimitListener(logging.handlers.QueueListener):
+    """QueueListener which also writes the expired counts of the rate limiter while the queue is idle."""
+
+    def __init__(self, queue, rate_limiter: RateLimitFilter, *handlers, flush_interval: float = 5, **kwargs):
+        super().__init__(queue, *handlers, **kwargs)
+        self.rate_limiter   = rate_limiter
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.flush_interval if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+            for summary in self.rate_limiter.flush():
+                self.handle(summary)
+
+    def flush(self):
+        """Write the counts of every suppressed message, such as on exit."""
+        for summary in self.rate_limiter.flush(force=True):
+            self.handle(summary)
+
+class LogPipeline:
+    """Queue handler on the root logger, written out by a background listener."""
+
+    def __init__(self, stream=None):
+        self.queue          = queue.SimpleQueue()
+        self.rate_limiter   = RateLimitFilter()
+        self.queue_handler  = logging.handlers.QueueHandler(self.queue)
+        self.queue_handler.addFilter(self.rate_limiter)
+        self.stream_handler = logging.StreamHandler(stream)
+        self.stream_handler.setFormatter(ColorFormatter())
+        self.listener       = RateLimitListener(self.queue, self.rate_limiter, self.stream_handler, respect_handler_level=True)
+        self.started        = False
+
+    def configure(self, log_format: str = 'text', rate_limit: float = 300):
+        self.stream_handler.setFormatter(JsonFormatter() if log_format == 'json' else ColorFormatter())
+        self.rate_limiter.interval = rate_limit
+
+    def start(self, logger: logging.Logger = None):
+        if self.started:
+            return
+        (logger or logging.getLogger()).addHandler(self.queue_handler)
+        self.listener.start()
+        self.started = True
+        # Write the records still queued on exit
+        atexit.register(self.stop)
+
+    def stop(self):
+        if not self.started:
+            return
+        self.started = False
+        self.listener.stop()
+        self.listener.flush()
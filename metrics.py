@@ -0,0 +1,178 @@
+## Prometheus metrics, exposed in the text format on /metrics
+## Minimal counters, gauges and histograms with labels, so that no extra
+## package is needed. The metrics of the poller are defined at the bottom.
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name       = name
+        self.doc        = documentation
+        self.labelnames = tuple(labelnames)
+        self._values    = {}
+        self._lock      = threading.Lock()
+
+    def _key(self, labels: dict):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, None, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.type}']
+        for name, key, extra, value in self.samples():
+            lines.append(f'{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """Its samples are named <name>_total, while HELP and TYPE use the name itself."""
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        if name.endswith('_total'):
+            raise ValueError(f'Counter {name} : give the name without the _total suffix, it is added to the samples')
+        super().__init__(name, documentation, labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        return [(f'{self.name}_total', key, extra, value) for _, key, extra, value in super().samples()]
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels    = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            cumulated = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulated += count
+                samples.append((f'{self.name}_bucket', key, ('le', _format_value(bound)), cumulated))
+            samples.append((f'{self.name}_count', key, None, cumulated))
+            samples.append((f'{self.name}_sum', key, None, total))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+REGISTRY = Registry()
+
+def start_server(port: int, address: str = '0.0.0.0', registry: Registry = REGISTRY):
+    """Serve the registry on http://address:port/metrics from a background thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+# Metrics of the poller
+dtu_request_seconds    = REGISTRY.register(Histogram('opendtu_dtu_request_seconds', 'Duration of the requests to OpenDTU', ['target']))
+domoticz_write_seconds = REGISTRY.register(Histogram('opendtu_domoticz_write_seconds', 'Duration of the Domoticz device updates', ['idx']))
+telegram_send_seconds  = REGISTRY.register(Histogram('opendtu_telegram_send_seconds', 'Duration of the Telegram sends'))
+cycle_seconds          = REGISTRY.register(Histogram('opendtu_cycle_seconds', 'Duration of a polling cycle', buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30, 60)))
+cycle_overruns         = REGISTRY.register(Counter('opendtu_cycle_overruns', 'Cycles which took longer than the polling interval'))
+dtu_failures           = REGISTRY.register(Counter('opendtu_inverter_failures', 'Requests to OpenDTU which returned no data', ['inverter']))
+domoticz_failures      = REGISTRY.register(Counter('opendtu_domoticz_failures', 'Domoticz device updates which failed', ['idx']))
+telegram_failures      = REGISTRY.register(Counter('opendtu_telegram_failures', 'Telegram messages dropped after all retries'))
+power_watts            = REGISTRY.register(Gauge('opendtu_power_watts', 'Current power', ['inverter']))
+yield_day_wh           = REGISTRY.register(Gauge('opendtu_yield_day_wh', 'Energy produced today', ['inverter']))
+yield_total_kwh        = REGISTRY.register(Gauge('opendtu_yield_total_kwh', 'Energy produced since installation', ['inverter']))
+gateway_up             = REGISTRY.register(Gauge('opendtu_gateway_up', 'Whether the OpenDTU gateway answers', ['gateway']))
+inverter_circuit_open  = REGISTRY.register(Gauge('opendtu_inverter_circuit_open', 'Whether the requests to the inverter are suspended', ['inverter']))
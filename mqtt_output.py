@@ -0,0 +1,82 @@
+## MQTT output for the Domoticz device updates
+## Domoticz reads {"idx": ..., "nvalue": 0, "svalue": "..."} messages on its
+## domoticz/in topic. All updates go over one persistent connection,
+## paho-mqtt reconnects in its network thread when the broker goes away.
+## Requires the optional package paho-mqtt (pip install paho-mqtt)
+
+import json
+import logging
+import threading
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+logger = logging.getLogger(__name__)
+
+class PublishError(OSError):
+    """The update could not be handed to the broker."""
+
+class DomoticzMqttOutput:
+    """Publish Domoticz udevice updates to the domoticz/in topic."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 1883, topic: str = 'domoticz/in', qos: int = 1,
+                 username: str = None, password: str = None, client_id: str = 'domoticz-opendtu', keepalive: int = 60,
+                 reconnect_min_delay: int = 1, reconnect_max_delay: int = 60):
+        if mqtt is None:
+            raise RuntimeError('MQTT output requires the paho-mqtt package')
+        self.host      = host
+        self.port      = port
+        self.topic     = topic
+        self.qos       = qos
+        self.keepalive = keepalive
+        self.connected = False
+        self._connected_event = threading.Event()
+        try:
+            # paho-mqtt >= 2.0
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+        except AttributeError:
+            self.client = mqtt.Client(client_id=client_id)
+        if username:
+            self.client.username_pw_set(username, password)
+        self.client.reconnect_delay_set(min_delay=reconnect_min_delay, max_delay=reconnect_max_delay)
+        self.client.on_connect    = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+
+    def start(self, timeout: float = 5):
+        """Connect in the background, and wait up to timeout seconds for the connection."""
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+        if not self._connected_event.wait(timeout):
+            logger.warning(f'MQTT broker {self.host}:{self.port} not connected yet, updates will fail until it is')
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    # Callback signatures differ between paho-mqtt 1.x and 2.x, only the reason code is used
+    def _on_connect(self, client, userdata, flags, reason_code, *args):
+        if getattr(reason_code, 'is_failure', reason_code != 0):
+            logger.error(f'MQTT connection to {self.host}:{self.port} refused : {reason_code}')
+            return
+        logger.info(f'MQTT connected to {self.host}:{self.port}')
+        self.connected = True
+        self._connected_event.set()
+
+    def _on_disconnect(self, client, userdata, *args):
+        if self.connected:
+            logger.warning(f'MQTT disconnected from {self.host}:{self.port}, reconnecting')
+        self.connected = False
+        self._connected_event.clear()
+
+    def publish(self, idx, svalue: str, nvalue: int = 0):
+        """Publish one device update, raises PublishError when the broker is not reachable."""
+        if not self.connected:
+            # Do not let paho queue it, the caller keeps failed updates for replay
+            raise PublishError(f'not connected to {self.host}:{self.port}')
+        payload = json.dumps({'idx': int(idx), 'nvalue': nvalue, 'svalue': svalue})
+        info = self.client.publish(self.topic, payload, qos=self.qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise PublishError(mqtt.error_string(info.rc))
+        return info
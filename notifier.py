@@ -0,0 +1,170 @@
+## Non-blocking Telegram notifications
+## Messages are put in a queue and sent by a background worker, so the
+## polling loop never waits on api.telegram.org. Messages queued within
+## coalesce_window seconds are merged into a single Telegram message, sends
+## are spaced by at least min_interval seconds, a 429 answer is honoured
+## with its retry_after, and failed sends are retried with a growing delay.
+
+import logging
+import queue
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+_STOP = object()
+
+def _cut(line: str, max_length: int):
+    """Split a line longer than max_length, never inside an HTML tag."""
+    pieces = []
+    while len(line) > max_length:
+        end = max_length
+        opening = line.rfind('<', 0, end)
+        if opening > 0 and line.rfind('>', 0, end) < opening:
+            end = opening
+        pieces.append(line[:end])
+        line = line[end:]
+    return pieces + [line]
+
+def split_message(message: str, max_length: int = MAX_MESSAGE_LENGTH):
+    """Split a message longer than max_length on its line boundaries, so that the HTML tags of each line stay balanced."""
+    if len(message) <= max_length:
+        return [message]
+    parts = []
+    current = ''
+    for line in message.split('\n'):
+        for piece in _cut(line, max_length):
+            if current and len(current) + 1 + len(piece) > max_length:
+                parts.append(current)
+                current = ''
+            current = f'{current}\n{piece}' if current else piece
+    if current:
+        parts.append(current)
+    return parts
+
+def merge_messages(messages: list, max_length: int = MAX_MESSAGE_LENGTH):
+    """Join messages with blank lines, without going over max_length per merged message.
+
+    Messages are never cut, except one longer than max_length, which is split on its lines.
+    """
+    merged = []
+    current = ''
+    for message in (part for message in messages for part in split_message(message, max_length)):
+        if current and len(current) + 2 + len(message) > max_length:
+            merged.append(current)
+            current = ''
+        current = f'{current}\n\n{message}' if current else message
+    if current:
+        merged.append(current)
+    return merged
+
+class TelegramNotifier:
+    """Background worker sending queued messages to one Telegram chat."""
+
+    def __init__(self, token: str, chat_id: str, session, api_url: str = 'https://api.telegram.org',
+                 coalesce_window: float = 1, min_interval: float = 1, max_retries: int = 5, retry_delay: float = 2):
+        self.token           = token
+        self.chat_id         = chat_id
+        self.session         = session
+        self.api_url         = api_url.rstrip('/')
+        self.coalesce_window = coalesce_window
+        self.min_interval    = min_interval
+        self.max_retries     = max_retries
+        self.retry_delay     = retry_delay
+        self.sent            = 0
+        self.dropped         = 0
+        self._queue          = queue.Queue()
+        self._thread         = None
+        self._last_send      = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='telegram-notifier', daemon=True)
+        self._thread.start()
+
+    def retry_sequence_duration(self):
+        """Longest time spent on one message before it is dropped, 429 waits aside."""
+        timeout = getattr(self.session, 'timeout', None) or 0
+        request = sum(timeout) if isinstance(timeout, tuple) else timeout
+        return self.coalesce_window + self.max_retries * (self.min_interval + request) + self.retry_delay * (2 ** self.max_retries - 1)
+
+    def stop(self, timeout: float = None):
+        """Deliver the messages already queued, then stop the worker.
+
+        By default, waits for at least one full retry sequence.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout if timeout is not None else self.retry_sequence_duration())
+        self._thread = None
+
+    def send(self, message: str):
+        """Queue a message, never blocks."""
+        self._queue.put(message)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            message = self._queue.get()
+            if message is _STOP:
+                break
+            batch = [message]
+            # Wait a little for the rest of a burst (e.g. several inverters starting in the same cycle)
+            deadline = time.monotonic() + self.coalesce_window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if message is _STOP:
+                    stopping = True
+                    break
+                batch.append(message)
+            for text in merge_messages(batch):
+                self._deliver(text)
+
+    def _deliver(self, text: str):
+        url = f'{self.api_url}/bot{self.token}/sendMessage'
+        params = {'chat_id': self.chat_id, 'text': text, 'parse_mode': 'HTML'}
+        delay = self.retry_delay
+        for attempt in range(1, self.max_retries + 1):
+            # Respect the Telegram rate limit
+            wait = self._last_send + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_send = time.monotonic()
+            try:
+                with metrics.telegram_send_seconds.time():
+                    response = self.session.get(url, params=params)
+                result = response.json()
+            except Exception as e:
+                logger.error(f'Telegram send failed (attempt {attempt}/{self.max_retries}): {e}')
+            else:
+                if result.get('ok'):
+                    self.sent += 1
+                    return True
+                retry_after = (result.get('parameters') or {}).get('retry_after')
+                logger.error(f"Telegram send failed (attempt {attempt}/{self.max_retries}): {result.get('description')}")
+                if response.status_code == 429 and retry_after:
+                    time.sleep(retry_after)
+                    continue
+                if 400 <= response.status_code < 500:
+                    # The message itself is rejected, retrying will not help
+                    break
+            time.sleep(delay)
+            delay *= 2
+        self.dropped += 1
+        metrics.telegram_failures.inc()
+        logger.error(f'Telegram message dropped : {text}')
+        return False
@@ -0,0 +1,134 @@
+## Replay of a DTU capture (see capture.py, and capture_path in data.json)
+## The captured responses are fed through the cycle of run_v2.py: the same
+## parsing, production state, write filter and notifications, but the
+## Domoticz updates and Telegram messages are collected instead of sent.
+## A whole recorded day runs in seconds, as fast as possible by default:
+##   python replay.py capture.jsonl.gz --config data.json --output outputs.jsonl
+##   python replay.py capture.jsonl.gz --speed 1     (original speed)
+## Outputs of two versions can then be compared with diff.
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import types
+
+import capture
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class Replayer:
+    """Replace the network I/O of run_v2 with the capture, and collect the outputs."""
+
+    def __init__(self, run_v2):
+        self.run_v2    = run_v2
+        self.now       = None
+        self.responses = {}
+        self.outputs   = []
+        self.missing   = 0
+
+    def install(self):
+        self.run_v2.fetch_data = self.fetch_data
+        self.run_v2.deliver_domoticz_update = self.deliver
+        self.run_v2.telegram_notifier.send = self.notify
+        # The write heartbeat follows the time of the capture, not the wall clock
+        self.run_v2.domoticz_writes.clock = lambda: self.now
+        self.run_v2.energy_meter.clock = lambda: self.now
+        self.run_v2.inverter_breakers.clock = lambda: self.now
+        if self.run_v2.underperformance_detector is not None:
+            self.run_v2.underperformance_detector.clock = lambda: self.now
+
+    def fetch_data(self, url: str):
+        host, path = capture.split_url(url)
+        responses = self.responses.get((host, path))
+        if responses is None:
+            # Capture made with another DTU address
+            responses = next((data for (_, captured_path), data in self.responses.items() if captured_path == path and data), None)
+        if not responses:
+            self.missing += 1
+            return None
+        return responses.pop(0)
+
+    def deliver(self, idx, svalue: str):
+        self.outputs.append({'t': self.now, 'output': 'domoticz', 'idx': idx, 'svalue': svalue})
+        return types.SimpleNamespace(status_code=200)
+
+    def notify(self, message: str):
+        self.outputs.append({'t': self.now, 'output': 'telegram', 'message': message})
+
+    def run(self, path: str, speed: float = 0):
+        """Run one cycle per captured cycle. speed 0 is as fast as possible, 1 the original speed."""
+        cycles = 0
+        first = None
+        started = time.perf_counter()
+        for timestamp, responses in capture.read_cycles(path):
+            if first is None:
+                first = timestamp
+            elif speed > 0:
+                wait = (timestamp - first) / speed - (time.perf_counter() - started)
+                if wait > 0:
+                    time.sleep(wait)
+            self.now = timestamp
+            self.responses = responses
+            self.run_v2.run_cycle()
+            cycles += 1
+        return cycles, time.perf_counter() - started
+
+def replay_config(config_path: str, directory: str):
+    """Copy of data.json without any side effect: no sample database, capture, metrics or MQTT."""
+    with open(config_path, 'r') as file:
+        data = json.load(file)
+    data.setdefault('global_config', {}).update({
+        'state_path': os.path.join(directory, 'state.json'),
+        'sample_db': None,
+        'capture_path': None,
+        'metrics_port': None,
+        'snapshot_port': None,
+        'domoticz_output': 'http',
+        'config_reload': False
+    })
+    return data
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a DTU capture through the run_v2.py cycle, without network')
+    parser.add_argument('capture', help='Capture file, written by run_v2.py when capture_path is set')
+    parser.add_argument('--config', default='data.json', help='data.json with the inverters of the capture')
+    parser.add_argument('--speed', type=float, default=0, help='0 for as fast as possible, 1 for the original speed, 10 for ten times faster...')
+    parser.add_argument('--output', help='Save the Domoticz updates and Telegram messages to this JSON lines file')
+    parser.add_argument('--verbose', action='store_true', help='Keep the INFO logs of run_v2.py')
+    args = parser.parse_args()
+
+    capture_path = os.path.abspath(args.capture)
+    output_path = os.path.abspath(args.output) if args.output else None
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'data.json'), 'w') as file:
+            json.dump(replay_config(args.config, directory), file)
+        # run_v2.py loads data.json from the working directory at import
+        os.chdir(directory)
+        sys.path.insert(0, REPO_DIR)
+        import run_v2
+        if not args.verbose:
+            run_v2.logger.setLevel(logging.WARNING)
+        replayer = Replayer(run_v2)
+        replayer.install()
+        cycles, duration = replayer.run(capture_path, args.speed)
+        run_v2.runtime_state.flush()
+        os.chdir(working_directory)
+
+    writes = [output for output in replayer.outputs if output['output'] == 'domoticz']
+    messages = [output for output in replayer.outputs if output['output'] == 'telegram']
+    print(f'{cycles} cycles in {duration:0.2f} s ({cycles / duration if duration else 0:0.1f} cycles/s)')
+    print(f'{len(writes)} Domoticz updates ({len(writes) / cycles if cycles else 0:0.2f} per cycle), {len(messages)} Telegram messages, {replayer.missing} responses missing from the capture')
+    for message in messages:
+        print(f"  {time.strftime('%H:%M:%S', time.localtime(message['t']))}  {message['message'].splitlines()[0]}")
+    if output_path:
+        with open(output_path, 'w') as file:
+            for output in replayer.outputs:
+                file.write(json.dumps(output, ensure_ascii=False) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -1,97 +1,220 @@
 import requests
+import http_sessions
+import dtu_websocket
+import write_filter
+import config
+import capture
+import energy
+import circuit_breaker
+import underperformance
+import snapshot_api
+import notifier
+import state_store
+import scheduler
+import sample_store as sample_store_module
+import gateways as gateways_module
+import metrics
+import livedata
+import mqtt_output as mqtt_output_module
+import log_pipeline as log_pipeline_module
 import time
+import datetime
 import logging
-import json
+import asyncio
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 json_path = 'data.json'
 
-class CustomFormatter(logging.Formatter):
-
-    grey     = "\x1b[38;20m"
-    yellow   = "\x1b[33;20m"
-    red      = "\x1b[31;20m"
-    bold_red = "\x1b[31;1m"
-    reset    = "\x1b[0m"
-    OKBLUE   = '\033[94m'
-    OKCYAN   = '\033[96m'
-    OKGREEN  = '\033[92m'
-    format   = "%(asctime)s - %(name)s - %(levelname)s - %(message)s\t(%(filename)s:%(lineno)d)"
-
-    FORMATS = {
-        logging.DEBUG: OKBLUE + format + reset,
-        logging.INFO: OKCYAN + format + reset,
-        logging.WARNING: yellow + format + reset,
-        logging.ERROR: red + format + reset,
-        logging.CRITICAL: bold_red + format + reset
-    }
-
-    def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
-
 # create logger with 'spam_application'
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# create console handler with a higher log level
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-ch.setFormatter(CustomFormatter())
-logger.addHandler(ch)
-
-# Mapping between inverter serial numbers and their corresponding Domoticz IDX values
-def load_serial_data(file_path):
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-    return data
-
-# Fonction pour sauvegarder les données dans le fichier JSON
-def save_serial_data(file_path, data):
-    with open(file_path, 'w') as file:
-        json.dump(data, file, indent=4)
+# Records go through a queue, and are written to the console by a background thread
+log_output = log_pipeline_module.LogPipeline()
+log_output.start()
 
-# Load Datas from Json
-config_data = load_serial_data(json_path)
+# Load and validate data.json, it is then watched for changes between cycles
+current_config    = config.load_config(json_path)
+config_watcher    = config.ConfigWatcher(json_path, current_config)
 
 # Extraire les unités solaires et les configurations Telegram
-serial_to_datas   = config_data.get('solar_units', {})
-telegram_config   = config_data.get('telegram', {})
-global_solar      = config_data.get('global_solar', {})
-global_solar_P1   = config_data.get('global_solar_historic', {})
-global_config     = config_data.get('global_config', {})
+serial_to_datas   = current_config.solar_units
+telegram_config   = current_config.telegram
+global_config     = current_config.global_config
+http_config       = current_config.http
+mqtt_config       = current_config.mqtt
+log_output.configure(global_config.log_format, global_config.log_rate_limit)
+logging.getLogger().setLevel(global_config.log_level)
+logger.setLevel(global_config.log_level)
 
 # Define some Vars
 TG_TOKEN          = telegram_config.get('token')
 TG_CHATID         = telegram_config.get('chat_id')
-dtu_base_url      = global_config.get('dtu_base_url')
-domoticz_base_url = global_config.get('domoticz_base_url')
-sleep_duration    = global_config.get('sleep_duration')
-idx_global        = global_solar.get('idx')
-name_global       = global_solar.get('name')
-idx_global_P1     = global_solar_P1.get('idx')
-name_global_P1    = global_solar_P1.get('name')
-timeout_requests  = 1
+dtu_gateways      = gateways_module.load_gateways({'gateways': global_config.gateways, 'dtu_base_url': global_config.dtu_base_url})
+dtu_base_url      = dtu_gateways[0].base_url
+domoticz_base_url = global_config.domoticz_base_url
+sleep_duration    = global_config.sleep_duration
+single_request    = global_config.single_request
+max_data_age      = global_config.max_data_age
+async_engine      = global_config.async_engine
+max_concurrency   = global_config.max_concurrency
+use_websocket     = global_config.websocket
+websocket_stale_after = global_config.websocket_stale_after
+write_deadband    = global_config.write_deadband
+write_heartbeat   = global_config.write_heartbeat
+state_path        = global_config.state_path
+state_flush_delay = global_config.state_flush_delay
+night_sleep_duration = global_config.night_sleep_duration
+sunrise_ramp      = global_config.sunrise_ramp
+sample_db_path    = global_config.sample_db
+replay_batch      = global_config.replay_batch
+metrics_port      = global_config.metrics_port
+metrics_address   = global_config.metrics_address
+domoticz_output   = global_config.domoticz_output
+capture_path      = global_config.capture_path
+snapshot_port     = global_config.snapshot_port
+snapshot_address  = global_config.snapshot_address
+energy_tolerance  = global_config.energy_tolerance
+idx_global        = current_config.global_solar.idx
+name_global       = current_config.global_solar.name
+idx_global_P1     = current_config.global_solar_historic.idx
+name_global_P1    = current_config.global_solar_historic.name
 daily_report_sent = False
 notif_all_started = False
 notif_all_stopped = False
+# Pooled keep-alive sessions, with the timeouts and retry policy of each endpoint
+sessions          = http_sessions.create_sessions(http_config, {'dtu': len(dtu_gateways)})
+dtu_session       = sessions['dtu']
+domoticz_session  = sessions['domoticz']
+telegram_session  = sessions['telegram']
+# Background worker for Telegram messages
+telegram_notifier = notifier.TelegramNotifier(
+    TG_TOKEN,
+    TG_CHATID,
+    telegram_session,
+    api_url         = telegram_config.get('api_url', 'https://api.telegram.org'),
+    coalesce_window = telegram_config.get('coalesce_window', 1),
+    min_interval    = telegram_config.get('min_interval', 1),
+    max_retries     = telegram_config.get('max_retries', 5)
+)
+# Skip Domoticz writes when the value did not change (or stayed within the deadband)
+domoticz_writes   = write_filter.WriteFilter(deadband=write_deadband, heartbeat=write_heartbeat)
+# Runtime counters live in their own state file, data.json is only read
+runtime_state     = state_store.StateStore(state_path, flush_delay=state_flush_delay)
+failures          = runtime_state.get('failures', {})
+# Hourly and daily energy of each inverter and of the total, integrated from the power samples
+energy_meter      = energy.EnergyIntegrator(runtime_state.get('energy', {}), on_change=runtime_state.changed, max_gap=global_config.energy_max_gap, lock=runtime_state.lock)
+# Fixed-rate polling, slower at night
+poll_scheduler    = scheduler.AdaptiveScheduler(sleep_duration, night_sleep_duration, sunrise_ramp)
+# Gateway of each inverter, the first one when not set
+gateway_by_name   = {gateway.name: gateway for gateway in dtu_gateways}
+gateway_by_serial = {serial: gateway_by_name.get(unit.gateway, dtu_gateways[0]) for serial, unit in serial_to_datas.items()}
+# Gateways are polled in parallel
+gateway_pool      = ThreadPoolExecutor(max_workers=len(dtu_gateways)) if len(dtu_gateways) > 1 else None
+# Domoticz updates go over HTTP by default, or over one persistent MQTT connection
+mqtt_output       = mqtt_output_module.DomoticzMqttOutput(**mqtt_config) if domoticz_output == 'mqtt' else None
+# Inverters which do not answer are only probed from time to time
+inverter_breakers = circuit_breaker.BreakerSet(
+    max_probes        = global_config.breaker_max_probes,
+    failure_threshold = global_config.breaker_threshold,
+    probe_delay       = global_config.breaker_probe_delay,
+    max_probe_delay   = global_config.breaker_max_probe_delay
+)
+# Inverters producing less than their peers or than usual, requires numpy
+def create_underperformance_detector(units, settings: config.GlobalConfig):
+    if not settings.underperformance_alerts:
+        return None
+    return underperformance.UnderperformanceDetector(
+        {serial: unit.max_power for serial, unit in units.items()},
+        names     = {serial: unit.name for serial, unit in units.items()},
+        threshold = settings.underperformance_threshold,
+        window    = settings.underperformance_window
+    )
+underperformance_detector = create_underperformance_detector(serial_to_datas, global_config)
+# Local history of every sample, and queue of the updates Domoticz missed
+sample_store      = sample_store_module.SampleStore(sample_db_path) if sample_db_path else None
+domoticz_reachable = True
+# Devices with pending updates : their new values wait behind the old ones, so Domoticz gets them in order
+backlogged_devices = sample_store.pending_devices() if sample_store is not None else set()
+# Returned by the update functions instead of a response when the update is queued behind the pending ones
+QUEUED = 'queued'
+# Optional capture of the DTU responses, for replay.py
+dtu_capture       = capture.CaptureWriter(capture_path) if capture_path else None
+# Latest values served to the other local consumers
+live_snapshot     = snapshot_api.LiveSnapshot() if snapshot_port else None
+# Lock of the state store : protects the failure counters, updated from several threads by the async engine, from a flush
+state_lock        = runtime_state.lock
 
 # Initialize production state for each inverter
 solar_production = {serial: False for serial in serial_to_datas.keys()}
+# Set by SIGTERM or SIGINT, the loop stops after the current cycle
+shutdown_requested = threading.Event()
+
+# Save the production state and the notifications sent today, for a warm start
+def save_loop_state():
+    state = {
+        'date': datetime.date.today().isoformat(),
+        'producing': [serial for serial, producing in solar_production.items() if producing],
+        'daily_report_sent': daily_report_sent,
+        'notif_all_started': notif_all_started,
+        'notif_all_stopped': notif_all_stopped
+    }
+    if runtime_state.get('loop') != state:
+        runtime_state.set('loop', state)
 
-logger.info('Start...')
+# Restore the state saved today, so that a restart sends no notification again
+def restore_loop_state():
+    global daily_report_sent, notif_all_started, notif_all_stopped
+    state = runtime_state.get('loop')
+    if not state:
+        return
+    if state.get('date') != datetime.date.today().isoformat():
+        logger.info(f"Runtime state of {state.get('date')} discarded, starting from a cold state")
+        return
+    for serial in state.get('producing', []):
+        if serial in solar_production:
+            solar_production[serial] = True
+    daily_report_sent = state.get('daily_report_sent', False)
+    notif_all_started = state.get('notif_all_started', False)
+    notif_all_stopped = state.get('notif_all_stopped', False)
+    logger.info(f"Warm start : {sum(solar_production.values())} inverters producing, daily report {'sent' if daily_report_sent else 'not sent'}")
+
+restore_loop_state()
 
 def get_system_info():
     return fetch_data(f"{dtu_base_url}/api/system/status")
 
-def get_live_data():
-    return fetch_data(f"{dtu_base_url}/api/livedata/status")
+def get_live_data(base_url: str = None):
+    return fetch_data(f"{base_url or dtu_base_url}/api/livedata/status")
+
+def get_inverter_live_data(inverter: str, base_url: str = None):
+    return fetch_data(f"{base_url or dtu_base_url}/api/livedata/status?inv={inverter}")
 
-def get_inverter_live_data(inverter: str):
-    return fetch_data(f"{dtu_base_url}/api/livedata/status?inv={inverter}")
+def fetch_gateway_live_data(gateway):
+    with metrics.dtu_request_seconds.time(target=gateway.name):
+        live_data = get_live_data(gateway.base_url)
+    gateway.record(live_data)
+    metrics.gateway_up.set(1 if gateway.healthy else 0, gateway=gateway.name)
+    return live_data
+
+# Query Global Live Datas of every gateway, and merge them
+def get_all_live_data():
+    if gateway_pool is None:
+        live_datas = [fetch_gateway_live_data(dtu_gateways[0])]
+    else:
+        live_datas = list(gateway_pool.map(fetch_gateway_live_data, dtu_gateways))
+    return gateways_module.aggregate_live_data(dtu_gateways, live_datas)
 
 def fetch_data(url: str):
+    data = request_json(url)
+    if dtu_capture is not None:
+        dtu_capture.record(url, data)
+    return data
+
+def request_json(url: str):
     try:
-        response = requests.get(url=url, timeout=timeout_requests)
+        response = dtu_session.get(url)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.ConnectTimeout:
@@ -104,180 +227,600 @@ def fetch_data(url: str):
         logger.error(f"HTTP Request failed: {e}")
         return None
 
-def update_domoticz_solar(IDX: str, POWER: int, ENERGY: int):
-    update_url = f"{domoticz_base_url}/json.htm?type=command&param=udevice&idx={IDX}&nvalue=0&svalue={POWER};{ENERGY}"
+# Deliver one udevice update through the configured output (HTTP or MQTT), raises on failure
+def deliver_domoticz_update(IDX: str, SVALUE: str):
+    if mqtt_output is not None:
+        return mqtt_output.publish(IDX, SVALUE)
+    update_url = f"{domoticz_base_url}/json.htm?type=command&param=udevice&idx={IDX}&nvalue=0&svalue={SVALUE}"
+    response = domoticz_session.get(update_url)
+    response.raise_for_status()  # Lève une exception pour les codes d'état HTTP 4xx/5xx
+    return response
+
+# Send one udevice update to Domoticz
+def send_domoticz_update(IDX: str, SVALUE: str):
+    global domoticz_reachable
+    if str(IDX) in backlogged_devices:
+        # Never write a value before the older pending ones of the same device, they would overwrite it
+        sample_store.add_pending(IDX, SVALUE)
+        return QUEUED
     try:
-        response = requests.get(update_url)
-        response.raise_for_status()  # Lève une exception pour les codes d'état HTTP 4xx/5xx
+        with metrics.domoticz_write_seconds.time(idx=IDX):
+            response = deliver_domoticz_update(IDX, SVALUE)
+        domoticz_reachable = True
         return response
+    except mqtt_output_module.PublishError as mqtt_err:
+        logger.error(f'MQTT publish failed: {mqtt_err}')
     except requests.exceptions.HTTPError as http_err:
         logger.error(f'HTTP error occurred: {http_err}')  # Erreur HTTP (4xx ou 5xx)
-        return False
     except requests.exceptions.ConnectionError as conn_err:
         logger.error(f'Connection error occurred: {conn_err}')  # Erreur de connexion
-        return False
     except requests.exceptions.Timeout as timeout_err:
         logger.error(f'Timeout error occurred: {timeout_err}')  # Erreur de délai d'attente
-        return False
     except requests.exceptions.RequestException as req_err:
         logger.error(f'An error occurred: {req_err}')  # Erreur générique pour toutes les autres exceptions
-        return False
+    domoticz_reachable = False
+    metrics.domoticz_failures.inc(idx=IDX)
+    if sample_store is not None:
+        # Keep the update, it will be replayed once Domoticz is back
+        sample_store.add_pending(IDX, SVALUE)
+        backlogged_devices.add(str(IDX))
+    return False
+
+def update_domoticz_solar(IDX: str, POWER: int, ENERGY: int):
+    if not domoticz_writes.should_write(IDX, POWER, ENERGY):
+        return write_filter.SKIPPED
+    response = send_domoticz_update(IDX, f"{POWER};{ENERGY}")
+    if response:
+        domoticz_writes.record(IDX, POWER, ENERGY)
+    return response
 
 # used for total production of openDTU
 def update_domoticz_P1_meter(IDX: str, PROD: int, RETURN1: int):
-    update_url = f"{domoticz_base_url}/json.htm?type=command&param=udevice&idx={IDX}&nvalue=0&svalue=0;0;{RETURN1};0;0;{PROD}"
-    try:
-        response = requests.get(update_url)
-        response.raise_for_status()  # Lève une exception pour les codes d'état HTTP 4xx/5xx
-        return response
-    except requests.exceptions.HTTPError as http_err:
-        logger.error(f'HTTP error occurred: {http_err}')  # Erreur HTTP (4xx ou 5xx)
-        return False
-    except requests.exceptions.ConnectionError as conn_err:
-        logger.error(f'Connection error occurred: {conn_err}')  # Erreur de connexion
-        return False
-    except requests.exceptions.Timeout as timeout_err:
-        logger.error(f'Timeout error occurred: {timeout_err}')  # Erreur de délai d'attente
-        return False
-    except requests.exceptions.RequestException as req_err:
-        logger.error(f'An error occurred: {req_err}')  # Erreur générique pour toutes les autres exceptions
-        return False
+    if not domoticz_writes.should_write(IDX, PROD, RETURN1):
+        return write_filter.SKIPPED
+    response = send_domoticz_update(IDX, f"0;0;{RETURN1};0;0;{PROD}")
+    if response:
+        domoticz_writes.record(IDX, PROD, RETURN1)
+    return response
 
-def send_message_by_telegram(MESSAGE: str, TOKEN, CHATID):
-    import requests
-    url = f"https://api.telegram.org/bot{TOKEN}/sendMessage?chat_id={CHATID}&text={MESSAGE}&parse_mode=HTML"
-    try:
-        print(requests.get(url).json()) # this sends the message
-        return True
-    except Exception as e:
-        logger.error(e)
-        return False
+def describe_response(response):
+    if response is QUEUED:
+        return 'queued behind the pending updates'
+    if mqtt_output is not None:
+        return f"MQTT {mqtt_output.topic}"
+    return f"HTTP {response.status_code}"
+
+# Replay the updates which could not reach Domoticz, oldest first, before the writes of the cycle.
+# The first one also tells whether Domoticz is back.
+def replay_pending_updates():
+    global domoticz_reachable, backlogged_devices
+    if sample_store is None or not backlogged_devices:
+        return
+    pending = sample_store.oldest_pending(replay_batch)
+    if not pending:
+        backlogged_devices = set()
+        return
+    logger.info(f'Replaying {len(pending)} pending Domoticz updates')
+    sent = []
+    for pending_id, ts, idx, svalue in pending:
+        try:
+            deliver_domoticz_update(idx, svalue)
+        except (mqtt_output_module.PublishError, requests.exceptions.RequestException) as e:
+            logger.warning(f'Replay stopped, Domoticz failed again: {e}')
+            break
+        sent.append(pending_id)
+    if sent:
+        domoticz_reachable = True
+        sample_store.remove_pending(sent)
+        backlogged_devices = sample_store.pending_devices()
+
+# Hand the message to the Telegram worker, never blocks the polling loop
+def send_message_by_telegram(MESSAGE: str):
+    telegram_notifier.send(MESSAGE)
+    return True
+
+# Daily report from the local energy rollups, with the highest DTU YieldDay seen today when there is one
+def generate_daily_report(day: str = None):
+    # DTU YieldDay, or the integrated energy when it is missing or fails the cross-check
+    energy_in_kwh = round(energy_meter.day_energy('total', day, energy_tolerance) / 1000, 3)
+    report_lines = [f"🌞 Production Solaire du Jour : {energy_in_kwh} kWh"]
+    for serial, unit in serial_to_datas.items():
+        unit_in_kwh = round(energy_meter.day_energy(serial, day, energy_tolerance) / 1000, 3)
+        report_lines.append(f"<b>{unit.name}</b> : {unit_in_kwh} kWh")
+    return "\n".join(report_lines)
 
 # Fonction pour générer le résumé des échecs
 def generate_failure_summary(serial_to_datas):
     summary_lines = []
-    for serial, info in serial_to_datas.items():
-        name = info['name']
-        failures = info['failures']
-        summary_lines.append(f"<b>{name}</b>  ({serial})  :\n{failures} échecs de communication")
+    for serial, unit in serial_to_datas.items():
+        name = unit.name
+        failure_count = failures.get(serial, 0)
+        summary_lines.append(f"<b>{name}</b>  ({serial})  :\n{failure_count} échecs de communication")
     return "\n".join(summary_lines)
 
-while True:
-    try:
-        global_tic = time.perf_counter()
-        tic = time.perf_counter()
-        # Query Global Live Datas
-        live_data = get_live_data()
-        if live_data is not None:
-            # Update Global Solar Datas
-            current_power     = (round(float(live_data.get('total')['Power'].get('v')), 1))
-            yield_day         = int(live_data.get('total')['YieldDay'].get('v'))
-            yield_total       = int((live_data.get('total')['YieldTotal'].get('v'))*1000)
-            solar_response    = update_domoticz_solar(idx_global, current_power, yield_day)
-            p1_meter_response = update_domoticz_P1_meter(idx_global_P1, current_power, yield_total)
-            
-            if not solar_response:
-                logger.warning(f"Update of {name_global} Failed. Response is None")
-            elif solar_response.status_code != 200:
-                logger.error(f"1.1 - KO : HTTP : {solar_response.status_code}")
-            else:
-                logger.info(f"1.1 - OK : HTTP {solar_response.status_code}")
-            
-            if not p1_meter_response:
-                logger.warning(f"Update of {name_global_P1} Failed. Response is None.")
-            elif p1_meter_response.status_code != 200:
-                logger.error(f"1.2 - KO : HTTP : {p1_meter_response.status_code}")
-            else:
-                logger.info(f"1.2 - OK : HTTP {p1_meter_response.status_code}")
+# Check that an inverter entry of the global payload can be used as is.
+# Returns False when it is stale or lacks the fields we need,
+# so that the caller falls back to a dedicated ?inv= request.
+def is_status_inverter_usable(inverter):
+    if inverter is None or inverter.producing is None:
+        return False
+    if (inverter.data_age or 0) > max_data_age:
+        logger.debug(f"Data for inverter {inverter.serial} is stale ({inverter.data_age} s)")
+        return False
+    if not inverter.producing:
+        return True
+    power, energy = livedata.inverter_power(inverter)
+    return power is not None and energy is not None
+
+def record_sample(device: str, power: float, energy: float = None, yield_total: float = None):
+    metrics.power_watts.set(power, inverter=device)
+    if energy is not None:
+        metrics.yield_day_wh.set(energy, inverter=device)
+    if yield_total is not None:
+        metrics.yield_total_kwh.set(yield_total / 1000, inverter=device)
+    energy_meter.add(device, power, energy, yield_total)
+    if underperformance_detector is not None:
+        underperformance_detector.add(device, power)
+    if sample_store is not None:
+        sample_store.add_sample(device, power, energy, yield_total)
+    if live_snapshot is not None:
+        unit = serial_to_datas.get(device)
+        values = {'name': unit.name if unit is not None else name_global, 'producing': power > 0, 'power': power}
+        # A sleeping inverter keeps its last counters
+        if energy is not None:
+            values['yield_day'] = energy
+        if yield_total is not None:
+            values['yield_total'] = yield_total
+        live_snapshot.update(device, **values)
+
+def handle_inverter(serial: str, unit: config.SolarUnit, inverter: livedata.InverterRecord):
+    idx  = unit.idx
+    name = unit.name
+    # Check if the inverter is producing energy
+    if inverter.producing:
+        # Check if it was NOT producing during previous run :
+        if not solar_production[serial]:
+            # If it was not, then this a production start from the morning
+            solar_production[serial] = True
+            send_message_by_telegram(f"Starting Solar Production for {name}")
+        power, energy = livedata.inverter_power(inverter)
+        if power is None or energy is None:
+            logger.warning(f'Inverter {name} ({serial}) : Power DC or YieldDay missing')
+            return
+        power = round(float(power), 1)
+        energy = int(energy)
+        yield_total = inverter.inv[0].yield_total
+        logger.debug(f'Inverter {name} is producing energy, sending values to Domoticz')
+        record_sample(serial, power, energy, int(yield_total * 1000) if yield_total is not None else None)
+        response = update_domoticz_solar(idx, power, energy)
+        if response is write_filter.SKIPPED:
+            logger.debug(f"Inverter {name} ({serial}) : unchanged, update skipped")
+        elif not response:
+            logger.warning(f"Update of {name} ({serial}) Failed.")
         else:
-            logger.warning('No live_data received')
-        toc = time.perf_counter()
-        logger.info(f"1 - Duration : {toc - tic:0.4f} seconds.\n")
-        # Update Individual Solar Panel Datas
-        tic = time.perf_counter()
-        # Get the list off all inverters serial numbers
-        for serial, data in serial_to_datas.items():
-            idx  = data['idx']
-            name = data['name']
-            # For each serial number, query to openDTU
-            inverter_live_data = get_inverter_live_data(serial)
-            if inverter_live_data is not None:
-                if inverter_live_data and 'inverters' in inverter_live_data:
-                    inverter_data = inverter_live_data['inverters'][0]
-                    # Check if the inverter is producing energy
-                    if inverter_data['producing']:
-                        # Check if it was NOT producing during previous run :
-                        if not solar_production[serial]:
-                            # If it was not, then this a production start from the morning
-                            solar_production[serial] = True
-                            send_message_by_telegram(f"Starting Solar Production for {name}", TG_TOKEN, TG_CHATID)
-                        power = round(float(inverter_data['INV']['0']['Power DC']['v']), 1)
-                        energy = int(inverter_data['INV']['0']['YieldDay']['v'])
-                        logger.debug(f'Inverter {name} is producing energy, sending values to Domoticz')
-                        response = update_domoticz_solar(idx, power, energy)
-                        logger.info(f"Inverter {name} ({serial}) : HTTP {response.status_code}\n")
-                    else:
-                        # Check if it was producing during previous run :
-                        if solar_production[serial]:
-                            # If it was, then this is production end from the evening
-                            solar_production[serial] = False
-                            send_message_by_telegram(f"Ending Solar Production for {name}", TG_TOKEN, TG_CHATID)
-                        logger.warning(f'Inverter {name} is NOT producing energy')
-                        # Send Zero Values
-                        response = update_domoticz_solar(idx, 0, 0)
-                else:
-                    logger.warning('No inverters in live_data')
+            logger.info(f"Inverter {name} ({serial}) : {describe_response(response)}\n")
+    else:
+        # Check if it was producing during previous run :
+        if solar_production[serial]:
+            # If it was, then this is production end from the evening
+            solar_production[serial] = False
+            send_message_by_telegram(f"Ending Solar Production for {name}")
+        logger.warning(f'Inverter {name} is NOT producing energy')
+        record_sample(serial, 0)
+        # Send Zero Values
+        response = update_domoticz_solar(idx, 0, 0)
+
+# Update Global Solar Datas
+def update_global(live: livedata.LiveDataRecord):
+    if live is None:
+        logger.warning('No live_data received')
+        return
+    total = live.total
+    if total is None or None in (total.power, total.yield_day, total.yield_total):
+        logger.warning('No totals in live_data')
+        return
+    current_power     = round(float(total.power), 1)
+    yield_day         = int(total.yield_day)
+    yield_total       = int(total.yield_total * 1000)
+    record_sample('total', current_power, yield_day, yield_total)
+    solar_response    = update_domoticz_solar(idx_global, current_power, yield_day)
+    p1_meter_response = update_domoticz_P1_meter(idx_global_P1, current_power, yield_total)
+
+    if solar_response is write_filter.SKIPPED:
+        logger.debug(f"1.1 - {name_global} unchanged, update skipped")
+    elif not solar_response:
+        logger.warning(f"Update of {name_global} Failed. Response is None")
+    else:
+        logger.info(f"1.1 - OK : {describe_response(solar_response)}")
+
+    if p1_meter_response is write_filter.SKIPPED:
+        logger.debug(f"1.2 - {name_global_P1} unchanged, update skipped")
+    elif not p1_meter_response:
+        logger.warning(f"Update of {name_global_P1} Failed. Response is None.")
+    else:
+        logger.info(f"1.2 - OK : {describe_response(p1_meter_response)}")
+
+# Update Individual Solar Panel Datas, for one inverter
+# The global status is reused instead of a ?inv= request when reuse_status is set,
+# and is always used for an inverter whose circuit is open.
+def process_inverter(serial: str, unit: config.SolarUnit, status_inverters: dict, reuse_status: bool = True):
+    name = unit.name
+    inverter = status_inverters.get(serial)
+    if not reuse_status or not is_status_inverter_usable(inverter):
+        if not inverter_breakers.allow(serial, name):
+            # Circuit open : no request before the next probe, a sleeping inverter of the global status is still handled
+            if inverter is not None and inverter.producing is False:
+                handle_inverter(serial, unit, inverter)
             else:
-                logger.warning(f'No data received for inverter {name} ({serial})')
-                data['failures'] += 1
+                logger.debug(f'Inverter {name} ({serial}) skipped, circuit open')
+            return
+        breaker = inverter_breakers.get(serial, name)
+        # For each serial number, query to openDTU
+        with metrics.dtu_request_seconds.time(target=serial):
+            inverter_live_data = get_inverter_live_data(serial, gateway_by_serial[serial].base_url)
+        if inverter_live_data is None:
+            logger.warning(f'No data received for inverter {name} ({serial})')
+            breaker.record_failure()
+            metrics.dtu_failures.inc(inverter=serial)
+            with state_lock:
+                failures[serial] = failures.get(serial, 0) + 1
                 logger.warning(f'Incrementing Failure Count for {name}')
-                save_serial_data(json_path, config_data)
-        toc = time.perf_counter()
-        logger.info(f"2 - Duration : {toc - tic:0.4f} seconds.\n")
-
-        # Check if ALL inverters have stopped or started producing
-        all_inverters_stopped = all(not value for value in solar_production.values())
-        all_inverters_started = all(value for value in solar_production.values())
-        if all_inverters_stopped and not notif_all_stopped:
-            logger.info('All Inverters are NOT producing now')
-            send_message_by_telegram("🌜 All inverters Stopped!", TG_TOKEN, TG_CHATID)
-            notif_all_stopped = True
-            notif_all_started = False
-        elif all_inverters_started and not notif_all_started:
-            logger.info('All Inverters are producing now')
-            send_message_by_telegram("🔆 All inverters Started!", TG_TOKEN, TG_CHATID)
-            notif_all_started = True
-            notif_all_stopped = False
-            daily_report_sent = False
-            # Optionally, reset the failure counts for today (clear night events)
-            logger.info('Reset Failure counter for each inverter')
-            for serial in serial_to_datas:
-                serial_to_datas[serial]['failures'] = 0
-            save_serial_data(json_path, config_data)
-
-        # Send Daily Report
-        if not daily_report_sent and notif_all_stopped:
-            logger.info('Time to send Daily Production Message')
-            yield_day = (float(live_data.get('total')['YieldDay'].get('v')))
-            energy_in_kwh = yield_day / 1000
-            message = (f"🌞 Production Solaire du Jour : {energy_in_kwh} kWh")
-            send_message_by_telegram(message, TG_TOKEN, TG_CHATID)
-            daily_report_sent = True
-            ## Get all failures
-            failure_summary = generate_failure_summary(serial_to_datas)
-            logger.info("Summary of failures for today:")
-            logger.info(failure_summary)
-            logger.info("Sending Failures for today with Telegram...")
-            send_message_by_telegram(failure_summary, TG_TOKEN, TG_CHATID)
-            # Optionally, reset the failure counts for the next day
-            logger.info('Reset Failure counter for each inverter')
-            for serial in serial_to_datas:
-                serial_to_datas[serial]['failures'] = 0
-            save_serial_data(json_path, config_data)
-
-        global_toc = time.perf_counter()
-        logger.info(f"== Total Duration : {global_toc - global_tic:0.4f} seconds.\n")
-        logger.debug(f"Sleep for {sleep_duration} seconds...")
-        time.sleep(sleep_duration)
-    except Exception as e:
-        logger.critical(e)
+                runtime_state.changed()
+            return
+        if not inverter_live_data.get('inverters'):
+            logger.warning('No inverters in live_data')
+            breaker.record_failure()
+            return
+        inverter = livedata.parse_inverter(inverter_live_data['inverters'][0])
+        if inverter.reachable is False:
+            breaker.record_failure(unreachable=True)
+        else:
+            breaker.record_success()
+    handle_inverter(serial, unit, inverter)
+
+# Alert when an inverter produces less than its peers, or than usual
+def check_underperformance():
+    if underperformance_detector is None:
+        return
+    for message in underperformance_detector.tick():
+        send_message_by_telegram(message)
+
+# Make the values of the cycle visible to the snapshot readers, all at once
+def publish_snapshot():
+    if live_snapshot is not None:
+        live_snapshot.publish()
+
+# Apply the reachable flags of the global status to the circuit breakers, once per cycle
+def check_reachability(live: livedata.LiveDataRecord):
+    inverter_breakers.start_cycle()
+    for serial, unit in serial_to_datas.items():
+        inverter = live.inverters.get(serial) if live is not None else None
+        breaker = inverter_breakers.get(serial, unit.name)
+        if inverter is not None and inverter.reachable is not None:
+            breaker.observe(inverter.reachable)
+        metrics.inverter_circuit_open.set(1 if breaker.open else 0, inverter=serial)
+
+def reset_failures():
+    logger.info('Reset Failure counter for each inverter')
+    with state_lock:
+        for serial in serial_to_datas:
+            failures[serial] = 0
+        runtime_state.changed()
+
+# Remember when the production started today, to speed up the polling before the next sunrise
+def record_first_production():
+    today = datetime.date.today().isoformat()
+    if runtime_state.get('first_production', {}).get('date') != today:
+        runtime_state.set('first_production', {'date': today, 'time': datetime.datetime.now().strftime('%H:%M:%S')})
+
+# Seconds to sleep until the next cycle
+def next_sleep():
+    night = notif_all_stopped and not any(solar_production.values())
+    first_production = runtime_state.get('first_production', {})
+    expected_sunrise = datetime.time.fromisoformat(first_production['time']) if first_production.get('time') else None
+    interval = poll_scheduler.interval(night, expected_sunrise=expected_sunrise)
+    overruns = poll_scheduler.overruns
+    delay = poll_scheduler.next_delay(interval)
+    if poll_scheduler.overruns != overruns:
+        metrics.cycle_overruns.inc()
+    logger.debug(f"Sleep for {delay:0.2f} seconds (interval {interval:0.1f} s)...")
+    return delay
+
+# Apply a new configuration between two cycles. Only the inverters which were added,
+# removed or changed are touched, the production state of the others is kept.
+def apply_config(new: config.Config):
+    global current_config, serial_to_datas, gateway_by_serial, solar_production, domoticz_base_url, underperformance_detector
+    global sleep_duration, single_request, max_data_age, replay_batch, energy_tolerance, websocket_stale_after
+    global idx_global, name_global, idx_global_P1, name_global_P1
+    old = current_config
+    settings = new.global_config
+    added    = new.solar_units.keys() - old.solar_units.keys()
+    removed  = old.solar_units.keys() - new.solar_units.keys()
+    changed  = {serial for serial in new.solar_units.keys() & old.solar_units.keys() if new.solar_units[serial] != old.solar_units[serial]}
+    for serial in removed | changed:
+        # The next value is written to the (possibly new) device right away
+        domoticz_writes.forget(old.solar_units[serial].idx)
+    if live_snapshot is not None:
+        for serial in removed:
+            live_snapshot.remove(serial)
+    for old_device, new_device in ((old.global_solar, new.global_solar), (old.global_solar_historic, new.global_solar_historic)):
+        if old_device != new_device:
+            domoticz_writes.forget(old_device.idx)
+    restart = [key for key in config.RESTART_SETTINGS if getattr(settings, key) != getattr(old.global_config, key)]
+    restart += [section for section in ('http', 'mqtt') if getattr(new, section) != getattr(old, section)]
+    if restart:
+        logger.warning(f"Configuration change of {', '.join(restart)} needs a restart, ignored until then")
+
+    # Build everything first, then swap the references
+    production = {serial: solar_production.get(serial, False) for serial in new.solar_units}
+    detector   = underperformance_detector
+    underperformance_settings = ('underperformance_alerts', 'underperformance_threshold', 'underperformance_window')
+    if added or removed or changed or any(getattr(settings, key) != getattr(old.global_config, key) for key in underperformance_settings):
+        # The inverters are columns of the detector window, it starts over
+        detector = create_underperformance_detector(new.solar_units, settings)
+    by_serial  = {serial: gateway_by_name.get(unit.gateway, dtu_gateways[0]) for serial, unit in new.solar_units.items()}
+    current_config    = new
+    serial_to_datas   = new.solar_units
+    gateway_by_serial = by_serial
+    solar_production  = production
+    underperformance_detector = detector
+    domoticz_base_url = settings.domoticz_base_url
+    sleep_duration    = settings.sleep_duration
+    single_request    = settings.single_request
+    max_data_age      = settings.max_data_age
+    replay_batch      = settings.replay_batch
+    energy_tolerance  = settings.energy_tolerance
+    websocket_stale_after = settings.websocket_stale_after
+    idx_global        = new.global_solar.idx
+    name_global       = new.global_solar.name
+    idx_global_P1     = new.global_solar_historic.idx
+    name_global_P1    = new.global_solar_historic.name
+    domoticz_writes.deadband     = settings.write_deadband
+    domoticz_writes.heartbeat    = settings.write_heartbeat
+    runtime_state.flush_delay    = settings.state_flush_delay
+    energy_meter.max_gap         = settings.energy_max_gap
+    log_output.configure(settings.log_format, settings.log_rate_limit)
+    logging.getLogger().setLevel(settings.log_level)
+    logger.setLevel(settings.log_level)
+    inverter_breakers.configure(
+        settings.breaker_max_probes,
+        failure_threshold = settings.breaker_threshold,
+        probe_delay       = settings.breaker_probe_delay,
+        max_probe_delay   = settings.breaker_max_probe_delay
+    )
+    poll_scheduler.day_interval   = settings.sleep_duration
+    poll_scheduler.night_interval = max(settings.night_sleep_duration, settings.sleep_duration)
+    poll_scheduler.ramp_window    = settings.sunrise_ramp
+    telegram_notifier.token           = new.telegram.get('token')
+    telegram_notifier.chat_id         = new.telegram.get('chat_id')
+    telegram_notifier.coalesce_window = new.telegram.get('coalesce_window', 1)
+    telegram_notifier.min_interval    = new.telegram.get('min_interval', 1)
+    telegram_notifier.max_retries     = new.telegram.get('max_retries', 5)
+    logger.info(f'Configuration reloaded : {len(added)} inverters added, {len(removed)} removed, {len(changed)} changed')
+
+# Check data.json for changes, between two cycles
+def reload_config():
+    if not current_config.global_config.config_reload:
+        return
+    new = config_watcher.poll()
+    if new is not None:
+        apply_config(new)
+
+def check_production_state():
+    global daily_report_sent, notif_all_started, notif_all_stopped
+    # Check if ALL inverters have stopped or started producing
+    all_inverters_stopped = all(not value for value in solar_production.values())
+    all_inverters_started = all(value for value in solar_production.values())
+    if any(solar_production.values()):
+        record_first_production()
+    if all_inverters_stopped and not notif_all_stopped:
+        logger.info('All Inverters are NOT producing now')
+        send_message_by_telegram("🌜 All inverters Stopped!")
+        notif_all_stopped = True
+        notif_all_started = False
+    elif all_inverters_started and not notif_all_started:
+        logger.info('All Inverters are producing now')
+        send_message_by_telegram("🔆 All inverters Started!")
+        notif_all_started = True
+        notif_all_stopped = False
+        daily_report_sent = False
+        # Optionally, reset the failure counts for today (clear night events)
+        reset_failures()
+
+    # Send Daily Report
+    if not daily_report_sent and notif_all_stopped:
+        logger.info('Time to send Daily Production Message')
+        send_message_by_telegram(generate_daily_report())
+        daily_report_sent = True
+        ## Get all failures
+        failure_summary = generate_failure_summary(serial_to_datas)
+        logger.info("Summary of failures for today:")
+        logger.info(failure_summary)
+        logger.info("Sending Failures for today with Telegram...")
+        send_message_by_telegram(failure_summary)
+        # Optionally, reset the failure counts for the next day
+        reset_failures()
+    save_loop_state()
+
+def run_cycle():
+    global_tic = time.perf_counter()
+    if dtu_capture is not None:
+        dtu_capture.start_cycle()
+    replay_pending_updates()
+    tic = time.perf_counter()
+    # Query Global Live Datas
+    live = livedata.parse_live_data(get_all_live_data())
+    check_reachability(live)
+    update_global(live)
+    toc = time.perf_counter()
+    logger.info(f"1 - Duration : {toc - tic:0.4f} seconds.\n")
+    tic = time.perf_counter()
+    # In single request mode, reuse the inverters array of the global payload
+    status_inverters = live.inverters if live is not None else {}
+    for serial, unit in serial_to_datas.items():
+        process_inverter(serial, unit, status_inverters, single_request)
+    toc = time.perf_counter()
+    logger.info(f"2 - Duration : {toc - tic:0.4f} seconds.\n")
+    check_production_state()
+    check_underperformance()
+    publish_snapshot()
+    global_toc = time.perf_counter()
+    metrics.cycle_seconds.observe(global_toc - global_tic)
+    logger.info(f"== Total Duration : {global_toc - global_tic:0.4f} seconds.\n")
+
+# Async engine : the blocking HTTP calls run in worker threads, so that the
+# global update and every inverter are fetched and pushed to Domoticz concurrently.
+# At most max_concurrency inverters are in flight at the same time.
+async def run_cycle_async(semaphore: asyncio.Semaphore):
+    global_tic = time.perf_counter()
+    if dtu_capture is not None:
+        dtu_capture.start_cycle()
+    await asyncio.to_thread(replay_pending_updates)
+    tic = time.perf_counter()
+    # Query Global Live Datas of every gateway concurrently
+    live_datas = await asyncio.gather(*[asyncio.to_thread(fetch_gateway_live_data, gateway) for gateway in dtu_gateways])
+    live = livedata.parse_live_data(gateways_module.aggregate_live_data(dtu_gateways, live_datas))
+    check_reachability(live)
+    toc = time.perf_counter()
+    logger.info(f"1 - Duration : {toc - tic:0.4f} seconds.\n")
+    tic = time.perf_counter()
+    # In single request mode, reuse the inverters array of the global payload
+    status_inverters = live.inverters if live is not None else {}
+
+    async def limited(func, *args):
+        async with semaphore:
+            return await asyncio.to_thread(func, *args)
+
+    tasks = [limited(update_global, live)]
+    tasks += [limited(process_inverter, serial, unit, status_inverters, single_request) for serial, unit in serial_to_datas.items()]
+    # One failing inverter must not cancel the others
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.critical(result)
+    toc = time.perf_counter()
+    logger.info(f"2 - Duration : {toc - tic:0.4f} seconds.\n")
+    await asyncio.to_thread(check_production_state)
+    check_underperformance()
+    publish_snapshot()
+    global_toc = time.perf_counter()
+    metrics.cycle_seconds.observe(global_toc - global_tic)
+    logger.info(f"== Total Duration : {global_toc - global_tic:0.4f} seconds.\n")
+
+async def main_async():
+    # Enough worker threads for every concurrent request, plus the Telegram messages
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_concurrency + len(dtu_gateways) + 2))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    while not shutdown_requested.is_set():
+        try:
+            reload_config()
+            await run_cycle_async(semaphore)
+        except Exception as e:
+            logger.critical(e)
+        await asyncio.to_thread(shutdown_requested.wait, next_sleep())
+
+# Websocket ingestion : only the inverters reported by the DTU are processed, as soon as they change.
+# When nothing changed during sleep_duration, every inverter is refreshed from the local copy.
+def run_push_cycle(feed, changed: set, total_changed: bool):
+    tic = time.perf_counter()
+    replay_pending_updates()
+    live = livedata.parse_live_data(feed.snapshot())
+    check_reachability(live)
+    if not changed and not total_changed:
+        changed, total_changed = set(serial_to_datas), True
+    if total_changed and live is not None and live.total is not None:
+        update_global(live)
+    status_inverters = live.inverters if live is not None else {}
+    for serial in changed:
+        if serial in serial_to_datas:
+            process_inverter(serial, serial_to_datas[serial], status_inverters)
+    check_production_state()
+    check_underperformance()
+    publish_snapshot()
+    toc = time.perf_counter()
+    metrics.cycle_seconds.observe(toc - tic)
+    logger.info(f"== Push Duration ({len(changed)} inverters) : {toc - tic:0.4f} seconds.\n")
+
+def main_websocket():
+    feed = dtu_websocket.LiveDataFeed(dtu_base_url)
+    feed.start()
+    was_silent = False
+    while not shutdown_requested.is_set():
+        try:
+            reload_config()
+            silent = feed.is_stale(websocket_stale_after)
+            if silent != was_silent:
+                if silent:
+                    logger.warning(f'No websocket message for {websocket_stale_after} seconds, polling over HTTP')
+                else:
+                    logger.info('Websocket messages received again')
+                was_silent = silent
+            if feed.connected and not silent:
+                changed, total_changed = feed.wait_for_changes(sleep_duration)
+                run_push_cycle(feed, changed, total_changed)
+                # Push cycles are not scheduled, the fixed rate restarts from here on fallback
+                poll_scheduler.start()
+                continue
+            # Websocket is down or silent : fall back to HTTP polling until it delivers again
+            run_cycle()
+        except Exception as e:
+            logger.critical(e)
+        shutdown_requested.wait(next_sleep())
+    feed.stop()
+
+def main_sync():
+    while not shutdown_requested.is_set():
+        try:
+            reload_config()
+            run_cycle()
+        except Exception as e:
+            logger.critical(e)
+        shutdown_requested.wait(next_sleep())
+
+# SIGTERM or SIGINT : finish the current cycle, then stop. A second signal stops right away.
+def request_shutdown(signum, frame):
+    if shutdown_requested.is_set():
+        raise KeyboardInterrupt
+    logger.warning(f'{signal.Signals(signum).name} received, stopping after the current cycle')
+    shutdown_requested.set()
+
+def main():
+    logger.info('Start...')
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    telegram_notifier.start()
+    if metrics_port:
+        metrics.start_server(metrics_port, metrics_address)
+        logger.info(f'Metrics available on http://{metrics_address}:{metrics_port}/metrics')
+    if live_snapshot is not None:
+        snapshot_api.start_server(live_snapshot, snapshot_port, snapshot_address)
+        logger.info(f'Live data snapshot available on http://{snapshot_address}:{snapshot_port}/api/snapshot')
+    if mqtt_output is not None:
+        mqtt_output.start()
+    poll_scheduler.start()
+    try:
+        if use_websocket and len(dtu_gateways) > 1:
+            logger.warning('Websocket ingestion supports a single gateway, using HTTP polling')
+        if use_websocket and len(dtu_gateways) == 1:
+            logger.info('Using websocket ingestion, with HTTP polling as fallback')
+            main_websocket()
+        elif async_engine:
+            logger.info(f'Using async engine (max concurrency : {max_concurrency})')
+            asyncio.run(main_async())
+        else:
+            main_sync()
+    finally:
+        # Drain the queued writes, and never lose the runtime counters or the buffered samples on exit
+        save_loop_state()
+        energy_meter.checkpoint()
+        telegram_notifier.stop()
+        if mqtt_output is not None:
+            mqtt_output.stop()
+        if dtu_capture is not None:
+            dtu_capture.close()
+        runtime_state.flush()
+        if sample_store is not None:
+            sample_store.close()
+        logger.info('Stopped')
+
+if __name__ == "__main__":
+    main()
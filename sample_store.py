@@ -0,0 +1,114 @@
+## Local time-series store for the parsed samples (SQLite, WAL mode)
+## Every sample is buffered in memory and inserted in batches. Domoticz
+## updates which failed are kept in a pending table, and are replayed
+## oldest first once Domoticz answers again.
+
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS samples (
+    ts          REAL NOT NULL,
+    device      TEXT NOT NULL,
+    power       REAL,
+    energy      REAL,
+    yield_total REAL
+);
+CREATE INDEX IF NOT EXISTS samples_device_ts ON samples (device, ts);
+CREATE TABLE IF NOT EXISTS pending (
+    id     INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts     REAL NOT NULL,
+    idx    TEXT NOT NULL,
+    svalue TEXT NOT NULL
+);
+'''
+
+class SampleStore:
+    """Batched SQLite store for samples and pending Domoticz updates."""
+
+    def __init__(self, path: str, batch_size: int = 100, flush_interval: float = 30, clock=time.time):
+        self.path           = path
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self.clock          = clock
+        self._lock          = threading.Lock()
+        self._samples       = []
+        self._pending       = []
+        self._last_flush    = clock()
+        self._db            = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def add_sample(self, device: str, power: float, energy: float = None, yield_total: float = None):
+        with self._lock:
+            self._samples.append((self.clock(), device, power, energy, yield_total))
+            self._maybe_flush()
+
+    def add_pending(self, idx: str, svalue: str):
+        """Keep a Domoticz update which could not be sent."""
+        with self._lock:
+            self._pending.append((self.clock(), str(idx), svalue))
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self._samples) + len(self._pending) >= self.batch_size or self.clock() - self._last_flush >= self.flush_interval:
+            self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        self._last_flush = self.clock()
+        if not self._samples and not self._pending:
+            return
+        try:
+            with self._db:
+                self._db.executemany('INSERT INTO samples (ts, device, power, energy, yield_total) VALUES (?, ?, ?, ?, ?)', self._samples)
+                self._db.executemany('INSERT INTO pending (ts, idx, svalue) VALUES (?, ?, ?)', self._pending)
+        except sqlite3.Error as e:
+            logger.error(f'Failed to write samples to {self.path}: {e}')
+            return
+        self._samples.clear()
+        self._pending.clear()
+
+    def pending_count(self):
+        with self._lock:
+            self._flush()
+            return self._db.execute('SELECT COUNT(*) FROM pending').fetchone()[0]
+
+    def oldest_pending(self, limit: int = 100):
+        """Return up to limit pending updates, oldest first, as (id, ts, idx, svalue)."""
+        with self._lock:
+            self._flush()
+            return self._db.execute('SELECT id, ts, idx, svalue FROM pending ORDER BY id LIMIT ?', (limit,)).fetchall()
+
+    def pending_devices(self):
+        """IDX of the devices with pending updates."""
+        with self._lock:
+            self._flush()
+            return {row[0] for row in self._db.execute('SELECT DISTINCT idx FROM pending')}
+
+    def remove_pending(self, ids: list):
+        with self._lock:
+            with self._db:
+                self._db.executemany('DELETE FROM pending WHERE id = ?', [(pending_id,) for pending_id in ids])
+
+    def history(self, device: str, since: float = 0, until: float = None):
+        """Return the (ts, power, energy, yield_total) samples of one device."""
+        with self._lock:
+            self._flush()
+            return self._db.execute(
+                'SELECT ts, power, energy, yield_total FROM samples WHERE device = ? AND ts >= ? AND ts <= ? ORDER BY ts',
+                (device, since, until if until is not None else self.clock())
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._db.close()
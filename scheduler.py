@@ -0,0 +1,64 @@
+## Fixed-rate, adaptive scheduler for the polling loop
+## Ticks are planned from the previous tick, not from the end of the cycle,
+## so the cycle duration is subtracted from the sleep and the period does
+## not drift. A cycle longer than the interval is counted as an overrun and
+## the next tick starts right away, without trying to catch up.
+## The interval adapts to the production state: day_interval while the
+## inverters produce, night_interval once they all stopped, with a linear
+## ramp back to day_interval during the ramp_window before the sunrise.
+
+import datetime
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class AdaptiveScheduler:
+    """Compute the sleep before the next tick of the polling loop."""
+
+    def __init__(self, day_interval: float, night_interval: float, ramp_window: float = 3600, clock=time.monotonic):
+        self.day_interval   = day_interval
+        self.night_interval = max(night_interval, day_interval)
+        self.ramp_window    = ramp_window
+        self.clock          = clock
+        self.next_tick      = None
+        self.overruns       = 0
+        self.last_overrun   = 0
+
+    def start(self):
+        """Mark the start of the first tick."""
+        self.next_tick = self.clock()
+
+    def interval(self, night: bool, now: datetime.datetime = None, expected_sunrise: datetime.time = None):
+        """Return the polling interval for the current state."""
+        if not night:
+            return self.day_interval
+        if expected_sunrise is None or self.ramp_window <= 0:
+            return self.night_interval
+        now = now or datetime.datetime.now()
+        sunrise = datetime.datetime.combine(now.date(), expected_sunrise)
+        if sunrise < now - datetime.timedelta(seconds=self.ramp_window):
+            # Sunrise of today is long gone, look at the one of tomorrow
+            sunrise += datetime.timedelta(days=1)
+        seconds_to_sunrise = (sunrise - now).total_seconds()
+        if seconds_to_sunrise >= self.ramp_window:
+            return self.night_interval
+        if seconds_to_sunrise <= 0:
+            return self.day_interval
+        ratio = seconds_to_sunrise / self.ramp_window
+        return self.day_interval + (self.night_interval - self.day_interval) * ratio
+
+    def next_delay(self, interval: float):
+        """Return the number of seconds to sleep before the next tick."""
+        now = self.clock()
+        if self.next_tick is None:
+            self.next_tick = now
+        self.next_tick += interval
+        delay = self.next_tick - now
+        if delay < 0:
+            self.overruns += 1
+            self.last_overrun = -delay
+            logger.warning(f'Cycle overrun by {-delay:0.3f} seconds (interval {interval:0.1f} s, {self.overruns} overruns)')
+            self.next_tick = now
+            return 0
+        return delay
@@ -0,0 +1,172 @@
+## Local read-through API of the latest live data, so that other consumers
+## (Home Assistant, dashboards, scripts) do not poll the DTU themselves.
+## The poller updates the snapshot while it processes a cycle and publishes
+## it once at the end of the cycle. Readers are served from memory:
+##   GET /api/snapshot   totals and each inverter, with the time of the last
+##                       cycle and its age. The ETag only changes with the
+##                       values, If-None-Match gets a 304 Not Modified.
+##                       It includes a token drawn at start, as the version
+##                       counts again from 0 after a restart.
+##   GET /api/events     server-sent events: the whole snapshot, then the
+##                       entries changed by each published cycle.
+
+import json
+import logging
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two keepalive comments of an idle event stream
+KEEPALIVE = 15
+
+class LiveSnapshot:
+    """Latest values per device ('total' and each inverter serial), published once per cycle."""
+
+    def __init__(self, clock=time.time):
+        self.clock      = clock
+        self.version    = 0
+        self.instance   = secrets.token_hex(4)
+        self.timestamp  = None
+        self._entries   = {}
+        self._versions  = {}
+        self._pending   = {}
+        self._body      = self._render()
+        self._condition = threading.Condition()
+
+    def update(self, device: str, **values):
+        """Values of a device, visible to the readers at the next publish()."""
+        with self._condition:
+            pending = self._pending.get(device)
+            if pending is None:
+                self._pending[device] = values
+            else:
+                pending.update(values)
+
+    def remove(self, device: str):
+        with self._condition:
+            self._pending[device] = None
+
+    def publish(self):
+        """End of a cycle: apply the updates, and notify the event streams when a value changed."""
+        with self._condition:
+            self.timestamp = round(self.clock(), 3)
+            changed = []
+            for device, values in self._pending.items():
+                entry = self._entries.get(device)
+                if values is None:
+                    if entry is not None:
+                        del self._entries[device]
+                        changed.append(device)
+                    continue
+                merged = dict(entry or {})
+                merged.pop('changed', None)
+                merged.update(values)
+                if entry is not None and merged == {key: value for key, value in entry.items() if key != 'changed'}:
+                    continue
+                merged['changed'] = self.timestamp
+                self._entries[device] = merged
+                changed.append(device)
+            self._pending.clear()
+            if changed:
+                self.version += 1
+                for device in changed:
+                    self._versions[device] = self.version
+                self._body = self._render()
+            self._condition.notify_all()
+
+    def _render(self):
+        """Body of the snapshot without its leading timestamp and age, rebuilt only when a value changed."""
+        inverters = {device: entry for device, entry in self._entries.items() if device != 'total'}
+        body = json.dumps({'version': self.version, 'total': self._entries.get('total'), 'inverters': inverters}, ensure_ascii=False)
+        return body[1:].encode()
+
+    def tag(self, version: int = None):
+        """Identifier of a version, unique across restarts (ETag and event id)."""
+        return f'{self.instance}-{self.version if version is None else version}'
+
+    def etag(self, version: int = None):
+        # Weak : the age in the body changes, the values do not
+        return f'W/"{self.tag(version)}"'
+
+    def body(self):
+        """(ETag, age, JSON body) of the published snapshot."""
+        with self._condition:
+            timestamp, version, body = self.timestamp, self.version, self._body
+        age = round(self.clock() - timestamp, 1) if timestamp is not None else None
+        head = json.dumps({'timestamp': timestamp, 'age': age})[:-1].encode()
+        return self.etag(version), age, head + b', ' + body
+
+    def changes(self, since: int, timeout: float = KEEPALIVE):
+        """Wait for a version newer than since: (version, {device: entry or None}), or (since, None) on timeout."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.version > since, timeout):
+                return since, None
+            changed = {device: self._entries.get(device) for device, version in self._versions.items() if version > since}
+            return self.version, changed
+
+def start_server(snapshot: LiveSnapshot, port: int, address: str = '127.0.0.1'):
+    """Serve the snapshot on http://address:port/api/snapshot and /api/events from background threads."""
+
+    class SnapshotHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?')[0].rstrip('/')
+            if path in ('', '/api/snapshot'):
+                self.send_snapshot()
+            elif path == '/api/events':
+                self.send_events()
+            else:
+                self.send_error(404)
+
+        def send_snapshot(self):
+            etag, age, body = snapshot.body()
+            matches = [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]
+            not_modified = etag in matches or etag[2:] in matches or '*' in matches
+            self.send_response(304 if not_modified else 200)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            if age is not None:
+                self.send_header('Age', str(max(0, int(age))))
+            if not_modified:
+                self.end_headers()
+                return
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_events(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            try:
+                version = snapshot.version
+                # A reconnecting client which already has this version gets the changes only
+                if self.headers.get('Last-Event-ID') != snapshot.tag(version):
+                    _, _, body = snapshot.body()
+                    self.write_event('snapshot', version, body)
+                while True:
+                    new_version, changed = snapshot.changes(version)
+                    if changed is None:
+                        self.wfile.write(b': keepalive\n\n')
+                        self.wfile.flush()
+                        continue
+                    version = new_version
+                    self.write_event('update', version, json.dumps(changed, ensure_ascii=False).encode())
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def write_event(self, event: str, version: int, data: bytes):
+            self.wfile.write(f'event: {event}\nid: {snapshot.tag(version)}\n'.encode() + b'data: ' + data + b'\n\n')
+            self.wfile.flush()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), SnapshotHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='snapshot-server', daemon=True).start()
+    return server
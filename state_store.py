@@ -0,0 +1,86 @@
+## Runtime state store, kept apart from the data.json configuration
+## Values live in memory and are written behind: a change schedules a single
+## flush flush_delay seconds later, so a burst of changes costs one write.
+## Flushes go to a temporary file which then replaces the state file, so a
+## crash or power loss never leaves a half written file behind.
+## Code modifying the values returned by get() in place must hold lock, the
+## flush timer serializes the state under it.
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+class StateStore:
+    """JSON state file with debounced, atomic write-behind."""
+
+    def __init__(self, path: str, flush_delay: float = 30):
+        self.path        = path
+        self.flush_delay = flush_delay
+        self.data        = self._load()
+        self.lock       = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._dirty      = False
+        self._timer      = None
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.error(f'Invalid state file {self.path}, starting from an empty state: {e}')
+            return {}
+
+    def get(self, key: str, default=None):
+        with self.lock:
+            return self.data.setdefault(key, default)
+
+    def set(self, key: str, value):
+        with self.lock:
+            self.data[key] = value
+            self.changed()
+
+    def changed(self):
+        """Schedule a flush, call it after modifying a value returned by get() (under lock)."""
+        with self.lock:
+            self._dirty = True
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Write the state now if it changed since the last flush."""
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            content = json.dumps(self.data, indent=4)
+            self._dirty = False
+        with self._write_lock:
+            try:
+                self._write(content)
+            except OSError as e:
+                logger.error(f'Failed to write state file {self.path}: {e}')
+                with self.lock:
+                    self._dirty = True
+
+    def _write(self, content: str):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.state-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                file.write(content)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
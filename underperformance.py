@@ -0,0 +1,122 @@
+## Detection of inverters producing less than their peers
+## Power samples are normalized by the max_power of each inverter and
+## averaged per bucket (one minute by default) into a ring buffer holding a
+## day of buckets for the whole fleet, so adding a sample is a vector update.
+## Every check_interval seconds, batched statistics over the buffer compare
+## each inverter with the median of its peers, over the last hour of
+## production, and with its own ratio over the rest of the window. Buckets
+## where the fleet barely produces (dawn, dusk, night) are ignored.
+## Requires the optional package numpy (pip install numpy)
+
+import logging
+import threading
+import time
+import warnings
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+class UnderperformanceDetector:
+    """Rolling per-inverter power ratios, checked against peers and own history."""
+
+    def __init__(self, max_powers: dict, names: dict = None, threshold: float = 0.2, window: float = 86400, bucket_seconds: float = 60,
+                 check_interval: float = 900, recent: float = 3600, min_level: float = 0.1, alert_after: int = 2, clock=time.monotonic):
+        if np is None:
+            raise RuntimeError('underperformance detection requires the numpy package')
+        self.serials        = list(max_powers)
+        self.names          = [(names or {}).get(serial, serial) for serial in self.serials]
+        self.index          = {serial: position for position, serial in enumerate(self.serials)}
+        self.max_power      = np.array([max_powers[serial] or np.nan for serial in self.serials], dtype=np.float32)
+        self.threshold      = threshold
+        self.bucket_seconds = bucket_seconds
+        self.check_interval = check_interval
+        self.recent_buckets = max(1, int(recent / bucket_seconds))
+        self.min_level      = min_level
+        self.alert_after    = alert_after
+        self.clock          = clock
+        self.buffer         = np.full((max(2, int(window / bucket_seconds)), len(self.serials)), np.nan, dtype=np.float32)
+        self.position       = 0
+        self.flagged        = np.zeros(len(self.serials), dtype=np.int32)
+        self.alerted        = np.zeros(len(self.serials), dtype=bool)
+        self._sums          = np.zeros(len(self.serials), dtype=np.float64)
+        self._counts        = np.zeros(len(self.serials), dtype=np.int32)
+        self._bucket_end    = None
+        self._next_check    = None
+        self._lock          = threading.Lock()
+
+    def add(self, serial: str, power: float):
+        """Add a power sample (W) of an inverter to the current bucket."""
+        position = self.index.get(serial)
+        if position is None or power is None:
+            return
+        with self._lock:
+            self._sums[position] += power
+            self._counts[position] += 1
+
+    def tick(self):
+        """Close the bucket when due, and run the check when due. Returns the alert messages."""
+        now = self.clock()
+        if self._bucket_end is None:
+            self._bucket_end = now + self.bucket_seconds
+            self._next_check = now + self.check_interval
+            return []
+        if now < self._bucket_end:
+            return []
+        with self._lock:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.buffer[self.position] = self._sums / self._counts / self.max_power
+            self.position = (self.position + 1) % len(self.buffer)
+            self._sums[:] = 0
+            self._counts[:] = 0
+        self._bucket_end += self.bucket_seconds
+        if self._bucket_end <= now:
+            # The loop was stopped, the missed buckets are not filled
+            self._bucket_end = now + self.bucket_seconds
+        if now < self._next_check:
+            return []
+        self._next_check = now + self.check_interval
+        return self.check()
+
+    def scores(self):
+        """Per inverter (ratio to the peer median over the recent buckets, recent ratio / own older ratio).
+
+        Scores are NaN when there is not enough production in the window.
+        """
+        # Oldest bucket first
+        ordered = np.roll(self.buffer, -self.position, axis=0)
+        with warnings.catch_warnings():
+            # All-NaN buckets (night) are expected
+            warnings.simplefilter('ignore', RuntimeWarning)
+            fleet = np.nanmedian(ordered, axis=1)
+            producing = ordered[fleet >= self.min_level]
+            ratios = producing / fleet[fleet >= self.min_level][:, None]
+            recent = ratios[-self.recent_buckets:]
+            older = ratios[:-self.recent_buckets]
+            peer_score = np.nanmedian(recent, axis=0) if len(recent) >= self.recent_buckets // 2 else np.full(len(self.serials), np.nan)
+            own_score = peer_score / np.nanmedian(older, axis=0) if len(older) >= self.recent_buckets else np.full(len(self.serials), np.nan)
+        return peer_score, own_score
+
+    def check(self):
+        if len(self.serials) < 2:
+            return []
+        peer_score, own_score = self.scores()
+        limit = 1 - self.threshold
+        # NaN compares as False : no alert without data
+        low = (peer_score < limit) | (own_score < limit)
+        known = ~np.isnan(peer_score)
+        self.flagged = np.where(low, self.flagged + 1, np.where(known, 0, self.flagged))
+        messages = []
+        for position in np.flatnonzero((self.flagged >= self.alert_after) & ~self.alerted):
+            self.alerted[position] = True
+            usual = f', {own_score[position]:.0%} of its usual level' if not np.isnan(own_score[position]) else ''
+            messages.append(f'⚠️ Inverter {self.names[position]} underperforms : {peer_score[position]:.0%} of its peers{usual}')
+        for position in np.flatnonzero(self.alerted & known & ~low):
+            self.alerted[position] = False
+            messages.append(f'✅ Inverter {self.names[position]} is back to normal : {peer_score[position]:.0%} of its peers')
+        for message in messages:
+            logger.warning(message)
+        return messages
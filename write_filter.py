@@ -0,0 +1,37 @@
+## Change detection for Domoticz device writes
+## The last value pushed to each Domoticz IDX is kept, and a new write is
+## skipped when nothing changed, or when only the power moved by less than
+## the deadband. A heartbeat write is still forced after heartbeat seconds,
+## so that Domoticz never marks the device as timed out.
+
+import time
+
+# Returned by the update functions instead of a response when a write is skipped
+SKIPPED = 'skipped'
+
+class WriteFilter:
+    """Remember the last value written per IDX and decide if a new write is needed."""
+
+    def __init__(self, deadband: float = 0, heartbeat: float = 300, clock=time.monotonic):
+        self.deadband  = deadband
+        self.heartbeat = heartbeat
+        self.clock     = clock
+        self.last      = {}
+
+    def should_write(self, idx, power, *values):
+        last = self.last.get(idx)
+        if last is None:
+            return True
+        last_time, last_power, last_values = last
+        if self.clock() - last_time >= self.heartbeat:
+            return True
+        if values != last_values:
+            return True
+        return abs(power - last_power) > self.deadband
+
+    def record(self, idx, power, *values):
+        """Record a successful write."""
+        self.last[idx] = (self.clock(), power, values)
+
+    def forget(self, idx):
+        self.last.pop(idx, None)